@@ -4,18 +4,71 @@ Uses basic techniques for contextual anomaly analysis
 """
 
 import numpy as np
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from loguru import logger
+from collections import OrderedDict, defaultdict
+import hashlib
 import time
 import json
 
 
+# Cosine distance under which a cached context is reused for a new feature
+# vector. Real frame features are never bit-identical, so exact-key lookups
+# alone almost never hit.
+NEAREST_CONTEXT_MAX_DISTANCE = 0.05
+
+# Anomaly-score cut points at which retrieve_context's context type or
+# recommendations change; a cached context is only reused within one band
+CONTEXT_SCORE_BANDS = (0.4, 0.6, 0.7, 0.8)
+
+
+def _feature_key(features: np.ndarray) -> int:
+    """64-bit cache key hashed straight from the feature buffer (no tobytes() copy)"""
+    digest = hashlib.blake2b(np.ascontiguousarray(features).data, digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _score_band(anomaly_score: float) -> int:
+    """Index of the CONTEXT_SCORE_BANDS band an anomaly score falls in"""
+    band = 0
+    for cut in CONTEXT_SCORE_BANDS:
+        if anomaly_score > cut:
+            band += 1
+    return band
+
+
 class SimpleRAGSystem:
     """
     Simple RAG system implementation for AutoVision
     
     Uses basic retrieval and generation techniques to provide context for anomaly detection
     """
+
+    # Static recommendation lists, built once instead of on every detection
+    _CONTEXT_REC_CRITICAL = ("Immediate attention required",
+                             "Consider alerting security personnel",
+                             "Review related camera feeds")
+    _CONTEXT_REC_HIGH = ("Monitor situation closely",
+                         "Check for pattern continuation",
+                         "Review historical data")
+    _CONTEXT_REC_MEDIUM = ("Continue monitoring",
+                           "Log for pattern analysis")
+    _CONTEXT_REC_NORMAL = ("Normal operation",)
+
+    _DETECTION_REC_CRITICAL = ("Alert security personnel immediately",
+                               "Review live video feed",
+                               "Consider activating emergency protocols")
+    _DETECTION_REC_HIGH = ("Monitor situation closely",
+                           "Review historical data for patterns",
+                           "Consider manual verification")
+    _DETECTION_REC_LOW = ("Log for statistical analysis",
+                          "Continue normal monitoring")
+
+    _TYPE_RECOMMENDATIONS = {
+        "crowd_gathering": "Check for overcrowding or a gathering forming",
+        "running": "Check whether the subject is fleeing or in distress",
+        "loitering": "Check whether the subject is authorized to be in this area",
+    }
     
     def __init__(self):
         """Initialize the RAG system"""
@@ -43,12 +96,24 @@ class SimpleRAGSystem:
             ]
         }
         
-        # Simple retrieval cache
-        self.retrieval_cache = {}
+        # Set mirror of each knowledge_base list for O(1) duplicate checks
+        self._kb_sets = defaultdict(set, {k: set(v) for k, v in self.knowledge_base.items()})
+
+        # Simple retrieval cache (LRU: hits move to the end, eviction pops the front)
+        self.retrieval_cache = OrderedDict()
         self.cache_max_size = 100
         self.cache_hits = 0
         self.cache_misses = 0
 
+        # Normalized feature vectors of the cached contexts, one row per slot,
+        # searched with a single matrix-vector product (exact nearest neighbour;
+        # at cache_max_size rows this is cheaper than maintaining an ANN index)
+        self._context_vectors = None
+        self._slot_used = np.zeros(self.cache_max_size, dtype=bool)
+        self._slot_bands = np.zeros(self.cache_max_size, dtype=np.int8)
+        self._slot_keys: List[Optional[Tuple[int, int]]] = [None] * self.cache_max_size
+        self._key_slots: Dict[Tuple[int, int], int] = {}
+
         logger.info("Simple RAG system initialized")
 
     def retrieve_context(self, features: np.ndarray, anomaly_score: float) -> Dict[str, Any]:
@@ -62,13 +127,28 @@ class SimpleRAGSystem:
         Returns:
             Context information for analysis
         """
-        # Simple feature-based retrieval (demo)
-        feature_hash = hash(features.tobytes()) % 1000
+        # Simple feature-based retrieval (demo). The context also depends on
+        # the score, so cache entries are keyed on (features, score band) and
+        # the score-continuous confidence is recomputed on every hit.
+        band = _score_band(anomaly_score)
+        cache_key = (_feature_key(features), band)
+        confidence = min(0.9, 0.5 + anomaly_score * 0.4)
 
-        # Check cache first
-        if feature_hash in self.retrieval_cache:
+        # Check cache first: exact key, then nearest cached feature vector
+        if cache_key in self.retrieval_cache:
             self.cache_hits += 1
-            return self.retrieval_cache[feature_hash]
+            self.retrieval_cache.move_to_end(cache_key)
+            return {**self.retrieval_cache[cache_key], "confidence": confidence}
+
+        query = np.asarray(features, dtype=np.float32).reshape(-1)
+        norm = float(np.linalg.norm(query))
+        if norm > 0:
+            query = query / norm
+        nearest_key = self._nearest_cached_key(query, band)
+        if nearest_key is not None:
+            self.cache_hits += 1
+            self.retrieval_cache.move_to_end(nearest_key)
+            return {**self.retrieval_cache[nearest_key], "confidence": confidence}
         self.cache_misses += 1
 
         # Generate context based on anomaly score
@@ -85,44 +165,65 @@ class SimpleRAGSystem:
         context = {
             "type": context_type,
             "relevant_patterns": relevant_patterns,
-            "confidence": min(0.9, 0.5 + anomaly_score * 0.4),
-            "recommendations": self._generate_recommendations(anomaly_score)
+            "confidence": confidence,
+            "recommendations": self._recommendations_by_score(anomaly_score)
         }
         
         # Cache the result
-        if len(self.retrieval_cache) >= self.cache_max_size:
-            # Remove oldest entry
-            oldest_key = next(iter(self.retrieval_cache))
-            del self.retrieval_cache[oldest_key]
-        
-        self.retrieval_cache[feature_hash] = context
+        self._cache_put(cache_key, context)
+        if norm > 0:
+            self._store_vector(cache_key, query, band)
         return context
+
+    def _nearest_cached_key(self, query: np.ndarray, band: int) -> Optional[Tuple[int, int]]:
+        """Key of the closest cached context in the same score band, if close enough"""
+        if self._context_vectors is None or not self._key_slots:
+            return None
+        if query.shape[0] != self._context_vectors.shape[1]:
+            return None
+        similarities = self._context_vectors @ query
+        similarities[~self._slot_used | (self._slot_bands != band)] = -np.inf
+        slot = int(similarities.argmax())
+        if 1.0 - similarities[slot] < NEAREST_CONTEXT_MAX_DISTANCE:
+            return self._slot_keys[slot]
+        return None
+
+    def _store_vector(self, key: Tuple[int, int], vector: np.ndarray, band: int):
+        """Record the normalized feature vector behind a cached context"""
+        if self._context_vectors is None:
+            self._context_vectors = np.zeros((self.cache_max_size, vector.shape[0]), dtype=np.float32)
+        elif vector.shape[0] != self._context_vectors.shape[1]:
+            return
+        free = np.flatnonzero(~self._slot_used)
+        if free.size == 0:
+            return
+        slot = int(free[0])
+        self._context_vectors[slot] = vector
+        self._slot_used[slot] = True
+        self._slot_bands[slot] = band
+        self._slot_keys[slot] = key
+        self._key_slots[key] = slot
+
+    def _cache_put(self, key, value: Dict[str, Any]):
+        """Insert into the LRU retrieval cache, evicting (and unindexing) the oldest entry"""
+        self.retrieval_cache[key] = value
+        self.retrieval_cache.move_to_end(key)
+        if len(self.retrieval_cache) > self.cache_max_size:
+            evicted_key, _ = self.retrieval_cache.popitem(last=False)
+            slot = self._key_slots.pop(evicted_key, None)
+            if slot is not None:
+                self._slot_used[slot] = False
+                self._slot_keys[slot] = None
     
-    def _generate_recommendations(self, anomaly_score: float) -> List[str]:
-        """Generate recommendations based on anomaly score"""
-        recommendations = []
-        
+    def _recommendations_by_score(self, anomaly_score: float) -> List[str]:
+        """Generate recommendations based on anomaly score alone (used by retrieve_context)"""
         if anomaly_score > 0.8:
-            recommendations.extend([
-                "Immediate attention required",
-                "Consider alerting security personnel",
-                "Review related camera feeds"
-            ])
+            return list(self._CONTEXT_REC_CRITICAL)
         elif anomaly_score > 0.6:
-            recommendations.extend([
-                "Monitor situation closely",
-                "Check for pattern continuation",
-                "Review historical data"
-            ])
+            return list(self._CONTEXT_REC_HIGH)
         elif anomaly_score > 0.4:
-            recommendations.extend([
-                "Continue monitoring",
-                "Log for pattern analysis"
-            ])
-        else:
-            recommendations.append("Normal operation")
-        
-        return recommendations
+            return list(self._CONTEXT_REC_MEDIUM)
+        return list(self._CONTEXT_REC_NORMAL)
     
     def generate_summary(self, context: Dict[str, Any], anomaly_info: Dict[str, Any]) -> str:
         """
@@ -198,6 +299,9 @@ class SimpleRAGSystem:
     def clear_cache(self):
         """Clear the retrieval cache"""
         self.retrieval_cache.clear()
+        self._key_slots.clear()
+        self._slot_used[:] = False
+        self._slot_keys = [None] * self.cache_max_size
         logger.info("RAG system cache cleared")
     
     def analyze_detection(self, description: str, anomaly_score: float, anomaly_type: str,
@@ -300,39 +404,28 @@ class SimpleRAGSystem:
     
     def _generate_recommendations(self, anomaly_score: float, anomaly_type: str) -> List[str]:
         """Generate recommendations based on the detection"""
-        recommendations = []
-        
         if anomaly_score > 0.8:
-            recommendations.extend([
-                "Alert security personnel immediately",
-                "Review live video feed",
-                "Consider activating emergency protocols"
-            ])
+            base = self._DETECTION_REC_CRITICAL
         elif anomaly_score > 0.5:
-            recommendations.extend([
-                "Monitor situation closely",
-                "Review historical data for patterns",
-                "Consider manual verification"
-            ])
+            base = self._DETECTION_REC_HIGH
         else:
-            recommendations.extend([
-                "Log for statistical analysis",
-                "Continue normal monitoring"
-            ])
-            
+            base = self._DETECTION_REC_LOW
+
+        # Limit to 3 recommendations: the type-specific one only fits after
+        # the shorter low-severity list
+        if len(base) >= 3:
+            return list(base[:3])
+
         # Add type-specific recommendations (matches the real taxonomy
         # produced by backend/video_processor.py's _classify_anomaly_type)
-        if anomaly_type == "crowd_gathering":
-            recommendations.append("Check for overcrowding or a gathering forming")
-        elif anomaly_type == "running":
-            recommendations.append("Check whether the subject is fleeing or in distress")
-        elif anomaly_type == "loitering":
-            recommendations.append("Check whether the subject is authorized to be in this area")
+        recommendations = list(base)
+        if anomaly_type in self._TYPE_RECOMMENDATIONS:
+            recommendations.append(self._TYPE_RECOMMENDATIONS[anomaly_type])
         elif anomaly_type.endswith("_detected"):
             label = anomaly_type[: -len("_detected")].replace("_", " ")
             recommendations.append(f"Verify the recognized {label} and whether it belongs in this area")
 
-        return recommendations[:3]  # Limit to 3 recommendations
+        return recommendations[:3]
     
     def add_pattern(self, pattern_type: str, description: str, metadata: Optional[Dict[str, Any]] = None):
         """
@@ -353,31 +446,27 @@ class SimpleRAGSystem:
                 self.knowledge_base[pattern_type] = []
             
             # Avoid duplicates
-            if description not in self.knowledge_base[pattern_type]:
+            if description not in self._kb_sets[pattern_type]:
                 self.knowledge_base[pattern_type].append(description)
+                self._kb_sets[pattern_type].add(description)
                 
             # Keep knowledge base size manageable
             if len(self.knowledge_base[pattern_type]) > 20:
                 self.knowledge_base[pattern_type] = self.knowledge_base[pattern_type][-20:]
+                self._kb_sets[pattern_type] = set(self.knowledge_base[pattern_type])
                 
             # Create a simple embedding (in production, use proper embeddings)
             embedding = [hash(description) % 1000 / 1000.0 for _ in range(5)]
             
             # Cache the pattern for quick retrieval
             cache_key = f"{pattern_type}_{hash(description)}"
-            self.retrieval_cache[cache_key] = {
+            self._cache_put(cache_key, {
                 "description": description,
                 "pattern_type": pattern_type,
                 "metadata": metadata or {},
                 "embedding": embedding,
                 "frequency": 1
-            }
-            
-            # Manage cache size
-            if len(self.retrieval_cache) > self.cache_max_size:
-                # Remove oldest entries
-                oldest_key = next(iter(self.retrieval_cache))
-                del self.retrieval_cache[oldest_key]
+            })
                 
         except Exception as e:
             logger.error(f"Error adding pattern to RAG system: {e}")
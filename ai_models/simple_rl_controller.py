@@ -4,11 +4,77 @@ Uses basic RL techniques to optimize anomaly detection thresholds
 """
 
 import numpy as np
+import functools
 import os
 from typing import Dict, Any, List
 from loguru import logger
 import time
 
+# Parsed once at import rather than on every controller construction
+ANOMALY_THRESHOLD = float(os.getenv("ANOMALY_THRESHOLD", "0.5"))
+RL_LEARNING_RATE = float(os.getenv("RL_LEARNING_RATE", "0.01"))
+
+# Number of feedback signals buffered before the threshold is moved. 1 (the
+# default) applies every feedback immediately; larger values accumulate
+# +1/-1 signs and apply their net delta with a single clip on flush().
+RL_BATCH_SIZE = int(os.getenv("RL_BATCH_SIZE", "1"))
+
+# epsilon-greedy exploration on feedback that carries no corrective signal
+# (neither false positive nor false negative). Decays every decision. Off by
+# default: exploring moves the live detection threshold at random, so it is
+# opt-in (e.g. RL_EPSILON=0.1) for deployments that want it.
+RL_EPSILON = float(os.getenv("RL_EPSILON", "0"))
+RL_EPSILON_DECAY = 0.999
+RNG_BATCH_SIZE = 4096
+
+# Q-learning over the threshold: one state per 0.05 bucket of [0, 1], and
+# three actions. "stay" is index 0 so an untrained (all-zero) row's argmax
+# leaves the threshold where it is.
+RL_DISCOUNT_FACTOR = float(os.getenv("RL_DISCOUNT_FACTOR", "0.9"))
+N_STATES = 21
+ACTION_STAY, ACTION_DOWN, ACTION_UP = 0, 1, 2
+ACTION_DELTAS = (0.0, -0.05, 0.05)
+
+
+def _apply_feedback(threshold, fp, fn, is_fp, is_fn):
+    """Single feedback step: move/clamp the threshold and bump the matching counter"""
+    if is_fp:
+        # Too many false positives, increase threshold
+        threshold += 0.05
+        if threshold > 0.9:
+            threshold = 0.9
+        fp += 1
+    elif is_fn:
+        # Missing anomalies, decrease threshold
+        threshold -= 0.05
+        if threshold < 0.1:
+            threshold = 0.1
+        fn += 1
+    return threshold, fp, fn
+
+
+# Replaced by a numba-compiled build of _apply_feedback when numba is installed
+_feedback_kernel = _apply_feedback
+
+
+def _compile_feedback_kernel():
+    """JIT-compile and warm up the feedback kernel if numba is available (optional)"""
+    global _feedback_kernel
+    if _feedback_kernel is not _apply_feedback:
+        return
+    try:
+        from numba import njit
+    except ImportError:
+        logger.debug("numba not installed; using pure-Python RL feedback kernel")
+        return
+
+    try:
+        kernel = njit(cache=True)(_apply_feedback)
+        kernel(0.5, 0, 0, False, False)  # Compile now rather than on the first feedback
+        _feedback_kernel = kernel
+    except Exception as e:
+        logger.warning(f"Failed to compile RL feedback kernel, using pure Python: {e}")
+
 
 class SimpleRLController:
     """
@@ -16,30 +82,83 @@ class SimpleRLController:
     
     Uses basic reinforcement learning to adjust anomaly detection thresholds
     """
+
+    # Fixed attribute set: no per-instance __dict__, slot access on the hot path
+    __slots__ = (
+        "initial_threshold", "learning_rate", "current_threshold",
+        "adjustment_count", "false_positives", "false_negatives",
+        "_fb_buf", "_fb_len",
+        "epsilon", "_rng", "_rng_buf", "_rng_i",
+        "discount_factor", "Q", "_last_sa", "last_action",
+        "_summary_dirty", "_metrics_dirty", "_metrics", "_summary", "_last_updated",
+    )
     
     def __init__(self):
         """Initialize the RL controller"""
-        # Configuration
-        self.initial_threshold = float(os.getenv("ANOMALY_THRESHOLD", "0.5"))
-        self.learning_rate = float(os.getenv("RL_LEARNING_RATE", "0.01"))
-        
-        # State management
-        self.current_threshold = self.initial_threshold
-        self.adjustment_count = 0
-        
-        # Performance tracking
-        self.false_positives = 0
-        self.false_negatives = 0
+        # Configuration and state (env already parsed at import)
+        self.current_threshold = self.initial_threshold = ANOMALY_THRESHOLD
+        self.learning_rate = RL_LEARNING_RATE
+        self.adjustment_count = self.false_positives = self.false_negatives = 0
+
+        # Pending feedback signs (+1 false positive, -1 false negative, 0 other)
+        self._fb_buf = np.zeros(RL_BATCH_SIZE, dtype=np.int8) if RL_BATCH_SIZE > 1 else None
+        self._fb_len = 0
+
+        # Exploration: uniforms are drawn in batches and consumed one at a time
+        self.epsilon = RL_EPSILON
+        self._rng = np.random.default_rng()
+        self._rng_buf = self._rng.random(RNG_BATCH_SIZE)
+        self._rng_i = 0
+
+        # Q-table (threshold bucket x action) and the last (state, action) taken,
+        # which the next feedback grades
+        self.discount_factor = RL_DISCOUNT_FACTOR
+        self.Q = np.zeros((N_STATES, len(ACTION_DELTAS)), dtype=np.float32)
+        self._last_sa = None
+        # Action (ACTION_* index) applied by the most recent adjust_threshold
+        self.last_action = ACTION_STAY
+
+        # Cached status dicts, rebuilt only after the state has changed
+        self._last_updated = int(time.time())
+        self._summary_dirty = True
+        self._metrics_dirty = True
+        self._metrics = {}
+        self._summary = {
+            "model_type": "Simple RL Controller",
+            "current_threshold": None,
+            "total_adjustments": None,
+            "false_positives": None,
+            "false_negatives": None,
+            "training_status": None,
+            "q_table_size": int(self.Q.size),
+            "last_updated": None
+        }
         
-        logger.info(f"Simple RL controller initialized with threshold={self.current_threshold}")
+        logger.opt(lazy=True).info("Simple RL controller initialized with threshold={}",
+                                   lambda: self.current_threshold)
     
     def get_current_threshold(self) -> float:
         """Get the current anomaly detection threshold"""
         return self.current_threshold
+
+    def set_threshold(self, threshold: float):
+        """Set the threshold directly (e.g. restored from persisted training data)"""
+        self.current_threshold = threshold
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        """Invalidate the cached status dicts after a state change"""
+        self._last_updated = int(time.time())
+        self._summary_dirty = True
+        self._metrics_dirty = True
     
     def adjust_threshold(self, feedback: Dict[str, Any]) -> float:
         """
         Adjust threshold based on feedback
+
+        With RL_BATCH_SIZE > 1 the feedback is buffered and the threshold only
+        moves when the buffer fills (or flush() is called); until then the
+        returned value is the threshold as of the last flush.
         
         Args:
             feedback: Dict containing performance metrics
@@ -47,35 +166,182 @@ class SimpleRLController:
         Returns:
             New threshold value
         """
-        # Simple adjustment logic based on feedback
-        if feedback.get("false_positive", False):
-            # Too many false positives, increase threshold
-            self.current_threshold = min(0.9, self.current_threshold + 0.05)
-            self.false_positives += 1
-        elif feedback.get("false_negative", False):
-            # Missing anomalies, decrease threshold
-            self.current_threshold = max(0.1, self.current_threshold - 0.05)
-            self.false_negatives += 1
+        if self._fb_buf is not None:
+            if feedback.get("false_positive", False):
+                self._fb_buf[self._fb_len] = 1
+            elif feedback.get("false_negative", False):
+                self._fb_buf[self._fb_len] = -1
+            else:
+                self._fb_buf[self._fb_len] = 0
+            self._fb_len += 1
+            if self._fb_len == self._fb_buf.shape[0]:
+                self.flush()
+            # Buffered feedback moves the threshold only on flush()
+            self.last_action = ACTION_STAY
+        else:
+            is_fp = bool(feedback.get("false_positive", False))
+            is_fn = bool(feedback.get("false_negative", False))
+            state = self._state()
+
+            # This feedback is the outcome of the previous move: grade it
+            if self._last_sa is not None:
+                reward = -1.0 if (is_fp or is_fn) else max(-1.0, min(1.0, float(feedback.get("score", 0.0))))
+                self._update_q(self._last_sa[0], self._last_sa[1], reward, state)
+
+            threshold_before = self.current_threshold
+            if is_fp or is_fn:
+                # Simple adjustment logic based on feedback
+                self.current_threshold, self.false_positives, self.false_negatives = _feedback_kernel(
+                    self.current_threshold, self.false_positives, self.false_negatives, is_fp, is_fn
+                )
+                action = ACTION_UP if is_fp else ACTION_DOWN
+            else:
+                # No corrective signal: follow the learned policy (epsilon-greedy)
+                action = self._select_action(state)
+                delta = ACTION_DELTAS[action]
+                if delta:
+                    self.current_threshold = min(0.9, max(0.1, self.current_threshold + delta))
+            # A move clamped away at the [0.1, 0.9] bounds was not executed;
+            # the Q update must grade what actually happened
+            if self.current_threshold == threshold_before:
+                action = ACTION_STAY
+            self._last_sa = (state, action)
+            self.last_action = action
         
         self.adjustment_count += 1
+        self._mark_dirty()
         
         # Log adjustment
         if self.adjustment_count % 10 == 0:
-            logger.info(f"RL threshold adjusted to {self.current_threshold:.3f} (FP: {self.false_positives}, FN: {self.false_negatives})")
+            logger.opt(lazy=True).info("RL threshold adjusted to {:.3f} (FP: {}, FN: {})",
+                                       lambda: self.current_threshold,
+                                       lambda: self.false_positives,
+                                       lambda: self.false_negatives)
         
         return self.current_threshold
     
+    def adjust_threshold_batch(self, feedbacks: List[Dict[str, Any]]) -> float:
+        """
+        Adjust threshold for a batch of feedback in one vectorized step
+
+        Uses the same net-delta semantics as flush(): 0.05 per false positive
+        minus 0.05 per false negative, clipped to [0.1, 0.9] once at the end
+        rather than after every item. Any buffered feedback is applied first.
+        Exploration does not run on the batch path.
+
+        Args:
+            feedbacks: List of feedback dicts as accepted by adjust_threshold
+
+        Returns:
+            New threshold value
+        """
+        n = len(feedbacks)
+        self.flush()
+        if not n:
+            return self.current_threshold
+
+        fp = np.fromiter((bool(f.get("false_positive", False)) for f in feedbacks), dtype=bool, count=n)
+        fn = np.fromiter((bool(f.get("false_negative", False)) for f in feedbacks), dtype=bool, count=n)
+        fn &= ~fp  # false_positive wins when both are set, as in adjust_threshold
+        n_fp = int(np.count_nonzero(fp))
+        n_fn = int(np.count_nonzero(fn))
+
+        self.current_threshold = float(np.clip(self.current_threshold + 0.05 * (n_fp - n_fn), 0.1, 0.9))
+        self.false_positives += n_fp
+        self.false_negatives += n_fn
+        self.adjustment_count += n
+        self._mark_dirty()
+        return self.current_threshold
+
+    def _next_uniform(self) -> float:
+        """Next uniform [0, 1) sample from the pre-drawn batch, refilled in place"""
+        if self._rng_i == RNG_BATCH_SIZE:
+            self._rng.random(out=self._rng_buf)
+            self._rng_i = 0
+        value = self._rng_buf.item(self._rng_i)
+        self._rng_i += 1
+        return value
+
+    def _state(self) -> int:
+        """Q-table row for the current threshold (0.05-wide buckets)"""
+        return min(N_STATES - 1, max(0, int(round(self.current_threshold * (N_STATES - 1)))))
+
+    def _select_action(self, state: int) -> int:
+        """Greedy action index for a state; epsilon-greedy only when RL_EPSILON opts in"""
+        if self.epsilon > 0.0:
+            explore = self._next_uniform() < self.epsilon
+            self.epsilon *= RL_EPSILON_DECAY
+            if explore:
+                return int(self._next_uniform() * len(ACTION_DELTAS))
+        return int(self.Q[state].argmax())
+
+    def _update_q(self, state: int, action: int, reward: float, next_state: int):
+        """Q-learning update for the (state, action) pair that led to next_state"""
+        q = self.Q
+        q[state, action] = ((1.0 - self.learning_rate) * q[state, action]
+                            + self.learning_rate * (reward + self.discount_factor * q[next_state].max()))
+
+    def choose_action(self) -> float:
+        """
+        epsilon-greedy threshold adjustment
+
+        The chosen action is recorded as the one taken, so the next feedback
+        grades the move the caller executes.
+
+        Returns:
+            A random delta from ACTION_DELTAS with probability epsilon,
+            otherwise the greedy delta for the current threshold's Q-table row
+        """
+        state = self._state()
+        action = self._select_action(state)
+        self._last_sa = (state, action)
+        self.last_action = action
+        return ACTION_DELTAS[action]
+
+    def flush(self) -> float:
+        """
+        Apply any buffered feedback in one step
+
+        The net delta (0.05 per false positive minus 0.05 per false negative)
+        is clipped to [0.1, 0.9] once, rather than clamping after each step.
+
+        Returns:
+            New threshold value
+        """
+        if self._fb_len:
+            pending = self._fb_buf[:self._fb_len]
+            n_fp = int(np.count_nonzero(pending == 1))
+            n_fn = int(np.count_nonzero(pending == -1))
+            self.current_threshold = float(np.clip(self.current_threshold + 0.05 * (n_fp - n_fn), 0.1, 0.9))
+            self.false_positives += n_fp
+            self.false_negatives += n_fn
+            self._fb_len = 0
+            self._mark_dirty()
+        return self.current_threshold
+
+    def end_episode(self) -> float:
+        """
+        Close the current episode: apply all feedback buffered during it as
+        one aggregated update (batch Q-learning style deferred update)
+
+        Returns:
+            Threshold to use for the next episode
+        """
+        return self.flush()
+
     def get_performance_metrics(self) -> Dict[str, Any]:
         """Get current performance metrics"""
-        total_adjustments = self.false_positives + self.false_negatives
-        
-        return {
-            "current_threshold": self.current_threshold,
-            "total_adjustments": total_adjustments,
-            "false_positives": self.false_positives,
-            "false_negatives": self.false_negatives,
-            "adjustment_ratio": total_adjustments / max(1, self.adjustment_count)
-        }
+        if self._metrics_dirty:
+            total_adjustments = self.false_positives + self.false_negatives
+            self._metrics = {
+                "current_threshold": self.current_threshold,
+                "total_adjustments": total_adjustments,
+                "false_positives": self.false_positives,
+                "false_negatives": self.false_negatives,
+                "adjustment_ratio": total_adjustments / max(1, self.adjustment_count)
+            }
+            self._metrics_dirty = False
+        return self._metrics.copy()
     
     def reset(self):
         """Reset the controller to initial state"""
@@ -83,21 +349,36 @@ class SimpleRLController:
         self.false_positives = 0
         self.false_negatives = 0
         self.adjustment_count = 0
+        self._fb_len = 0
+        self.epsilon = RL_EPSILON
+        self.Q.fill(0.0)
+        self._last_sa = None
+        self.last_action = ACTION_STAY
+        self._mark_dirty()
         logger.info("Simple RL controller reset to initial state")
     
     def get_training_summary(self) -> Dict[str, Any]:
         """Get training summary for system status"""
-        return {
-            "model_type": "Simple RL Controller",
-            "current_threshold": self.current_threshold,
-            "total_adjustments": self.adjustment_count,
-            "false_positives": self.false_positives,
-            "false_negatives": self.false_negatives,
-            "training_status": "active" if self.adjustment_count > 0 else "idle",
-            "last_updated": int(time.time())
-        }
+        summary = self._summary
+        if self._summary_dirty:
+            summary["current_threshold"] = self.current_threshold
+            summary["total_adjustments"] = self.adjustment_count
+            summary["false_positives"] = self.false_positives
+            summary["false_negatives"] = self.false_negatives
+            summary["training_status"] = "active" if self.adjustment_count > 0 else "idle"
+            summary["last_updated"] = self._last_updated
+            self._summary_dirty = False
+        return summary.copy()
 
 
+@functools.cache
 def create_rl_controller():
-    """Factory function to create and initialize the RL controller"""
+    """
+    Factory function to create and initialize the RL controller
+
+    The controller is a process-wide singleton: every call returns the same
+    instance (threshold state is global, not per-user). Tests that need a
+    fresh controller can call create_rl_controller.cache_clear().
+    """
+    _compile_feedback_kernel()
     return SimpleRLController()
@@ -2,22 +2,89 @@
 API routes for AutoVision backend
 """
 
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, status, Request
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, status, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, RedirectResponse
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.security import HTTPAuthorizationCredentials
-from typing import List, Optional
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional, Set, Union
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import datetime
 import os
 import asyncio
+import hashlib
 from loguru import logger
 
-from backend.auth import get_current_user, AuthUser, auth_service, LoginRequest, SignupRequest, security
-from backend.video_cleanup import video_cleanup_service
+from backend.auth import get_current_user, get_user_from_header_or_query, AuthUser, AuthResponse, AuthService, get_auth_service, LoginRequest, SignupRequest, security
+from backend.video_cleanup import video_cleanup_service, CleanupBusyError
+from backend.video_processor import VideoMetadata
 
 # Import our custom SupabaseClient
 from backend.autovision_client import supabase_client
 
+# Largest accepted upload, parsed once at import
+MAX_VIDEO_SIZE_BYTES = int(os.getenv("MAX_VIDEO_SIZE_MB", "100")) * 1024 * 1024
+
+# Video MIME types accepted for upload: the formats the upload dropzone offers
+# (.mp4, .avi, .mov, .wmv, .flv, .webm) under both their registered and the
+# legacy names browsers report
+ALLOWED_VIDEO_TYPES = frozenset({
+    "video/mp4",
+    "video/avi", "video/x-msvideo", "video/msvideo",
+    "video/mov", "video/quicktime",
+    "video/wmv", "video/x-ms-wmv",
+    "video/flv", "video/x-flv",
+    "video/webm",
+})
+
+# Strong references to fire-and-forget storage deletes so they aren't GC'd mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+# Settings responses carry an ETag; clients must revalidate every time (a PUT
+# has to be visible immediately) but an unchanged body comes back as a 304
+SETTINGS_CACHE_CONTROL = "private, no-cache"
+# The only user_settings columns the settings endpoints return
+USER_SETTINGS_COLUMNS = "anomaly_threshold, frame_sampling_rate, auto_delete_old_videos, video_retention_days"
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header (possibly a list or weak tags) against an ETag"""
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def _settings_payload(settings_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Project a user_settings row onto the UserSettings fields, filling in defaults"""
+    return {
+        "anomaly_threshold": settings_data.get("anomaly_threshold", 0.5),
+        "frame_sampling_rate": settings_data.get("frame_sampling_rate", 10),
+        "auto_delete_old_videos": settings_data.get("auto_delete_old_videos", False),
+        "video_retention_days": settings_data.get("video_retention_days", 30),
+    }
+
+
+# Shared (read-only) payload for users with no saved settings and for lookup failures
+_DEFAULT_SETTINGS_PAYLOAD = _settings_payload({})
+
+
+def _settings_response(payload: Dict[str, Any], if_none_match: Optional[str] = None) -> Response:
+    """
+    Serialize a settings payload once with orjson and tag it with a strong
+    ETag over those bytes; a matching If-None-Match gets an empty 304
+    """
+    response = ORJSONResponse(payload, headers={"Cache-Control": SETTINGS_CACHE_CONTROL})
+    etag = '"' + hashlib.md5(response.body).hexdigest() + '"'
+    if _etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag, "Cache-Control": SETTINGS_CACHE_CONTROL}
+        )
+    response.headers["ETag"] = etag
+    return response
+
 
 class FeedbackRequest(BaseModel):
     """Feedback request model"""
@@ -48,27 +115,98 @@ class UserSettings(BaseModel):
 
 class SettingsUpdateRequest(BaseModel):
     """Settings update request model"""
-    anomaly_threshold: Optional[float] = None
-    frame_sampling_rate: Optional[int] = None
+    anomaly_threshold: Optional[float] = Field(None, ge=0, le=1)
+    frame_sampling_rate: Optional[int] = Field(None, gt=0)
     auto_delete_old_videos: Optional[bool] = None
-    video_retention_days: Optional[int] = None
+    video_retention_days: Optional[int] = Field(None, gt=0)
+
+
+class VideoSummary(BaseModel):
+    """Video row as returned to clients; unlisted columns pass through"""
+    model_config = ConfigDict(extra="allow")
+
+    id: str
+    user_id: str
+    filename: str
+    original_name: str
+    file_url: Optional[str] = None
+    file_size: Optional[int] = None
+    duration_seconds: Optional[float] = None
+    fps: Optional[float] = None
+    upload_status: Optional[str] = None
+    storage_provider: Optional[str] = None
+    created_at: Optional[str] = None
+
+
+class VideoListResponse(BaseModel):
+    """Video list response model"""
+    videos: List[VideoSummary]
+
+
+class EventSummary(BaseModel):
+    """Event row as returned to clients; unlisted columns pass through"""
+    model_config = ConfigDict(extra="allow")
+
+    id: str
+    video_id: str
+    event_type: str
+    anomaly_score: float
+    confidence: float
+    timestamp_seconds: float
+    frame_number: int
+    description: Optional[str] = None
+    is_alert: Optional[bool] = None
+    is_false_positive: Optional[bool] = None
+    created_at: Optional[str] = None
+
+
+class EventListResponse(BaseModel):
+    """Event list response model"""
+    events: List[EventSummary]
+
+
+class ErrorLoggingRoute(APIRoute):
+    """
+    Route class that maps unexpected handler errors to a logged 500
+
+    Routes only raise their own domain HTTPExceptions. Anything else is
+    logged with its traceback here and re-raised as an HTTPException, so it
+    still goes through the app's HTTPException handler inside the CORS
+    middleware (a bare Exception handler runs outside it and the browser
+    would see a CORS failure instead of the error body).
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            try:
+                return await handler(request)
+            except (StarletteHTTPException, RequestValidationError):
+                raise
+            except Exception as e:
+                logger.opt(exception=e).error(f"Unhandled error in {request.method} {request.url.path}: {e}")
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Internal server error"
+                )
+
+        return route_handler
 
 
 def create_api_router() -> APIRouter:
     """Create and configure API router"""
-    router = APIRouter()
+    # orjson encodes the list endpoints' payloads several times faster than
+    # the stdlib json encoder behind the default JSONResponse
+    router = APIRouter(route_class=ErrorLoggingRoute, default_response_class=ORJSONResponse)
     
     # Authentication routes
-    @router.post("/auth/signup", response_model=dict)
-    async def signup(signup_data: SignupRequest):
+    @router.post("/auth/signup", response_model=Union[AuthResponse, Dict[str, Any]])
+    async def signup(signup_data: SignupRequest, auth_service: AuthService = Depends(get_auth_service)):
         """Register a new user"""
         try:
-            result = await auth_service.signup(signup_data)
-            # Check if result is already a dict (email verification case) or AuthResponse object
-            if isinstance(result, dict):
-                return result
-            else:
-                return result.dict()
+            # Either an AuthResponse or a plain dict (email verification case)
+            return await auth_service.signup(signup_data)
         except HTTPException:
             raise
         except Exception as e:
@@ -78,12 +216,11 @@ def create_api_router() -> APIRouter:
                 detail="Registration failed"
             )
     
-    @router.post("/auth/login", response_model=dict)
-    async def login(login_data: LoginRequest):
+    @router.post("/auth/login", response_model=AuthResponse)
+    async def login(login_data: LoginRequest, auth_service: AuthService = Depends(get_auth_service)):
         """Authenticate user"""
         try:
-            result = await auth_service.login(login_data)
-            return result.dict()
+            return await auth_service.login(login_data)
         except HTTPException:
             raise
         except Exception as e:
@@ -93,12 +230,14 @@ def create_api_router() -> APIRouter:
                 detail="Authentication failed"
             )
     
-    @router.post("/auth/refresh")
-    async def refresh_token(refresh_token: str):
+    @router.post("/auth/refresh", response_model=AuthResponse)
+    async def refresh_token(refresh_token: str, auth_service: AuthService = Depends(get_auth_service)):
         """Refresh access token"""
         try:
             result = await auth_service.refresh_token(refresh_token)
-            return result.dict()
+            # Serialize straight to JSON bytes in pydantic-core, skipping the
+            # intermediate dict and FastAPI's encoding pass
+            return Response(content=result.model_dump_json(), media_type="application/json")
         except HTTPException:
             raise
         except Exception as e:
@@ -111,7 +250,8 @@ def create_api_router() -> APIRouter:
     @router.post("/auth/logout")
     async def logout(
         current_user: AuthUser = Depends(get_current_user),
-        credentials: HTTPAuthorizationCredentials = Depends(security)
+        credentials: HTTPAuthorizationCredentials = Depends(security),
+        auth_service: AuthService = Depends(get_auth_service)
     ):
         """Logout user"""
         try:
@@ -136,27 +276,30 @@ def create_api_router() -> APIRouter:
         """Upload a video for processing"""
         
         # Validate file type
-        if not file.content_type or not file.content_type.startswith('video/'):
+        if file.content_type not in ALLOWED_VIDEO_TYPES:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="File must be a video"
             )
         
-        # Check file size
-        max_size = int(os.getenv("MAX_VIDEO_SIZE_MB", "100")) * 1024 * 1024
-        file_data = await file.read()
-        
-        if len(file_data) > max_size:
+        # Starlette has already spooled the multipart body into file.file and
+        # recorded its size, so check that instead of copying the body again
+        file_size = file.size
+        if file_size is None:
+            file_size = await asyncio.to_thread(file.file.seek, 0, os.SEEK_END)
+        if file_size > MAX_VIDEO_SIZE_BYTES:
             raise HTTPException(
                 status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                detail=f"File size exceeds {max_size // (1024*1024)}MB limit"
-            )        
+                detail=f"File size exceeds {MAX_VIDEO_SIZE_BYTES // (1024*1024)}MB limit"
+            )
+        await file.seek(0)
+
         try:
             # Get video processor from app state
             video_processor = request.app.state.video_processor
             
             result = await video_processor.upload_video(
-                file_data=file_data,
+                file_obj=file.file,
                 filename=file.filename,
                 user_id=current_user.id
             )
@@ -170,74 +313,48 @@ def create_api_router() -> APIRouter:
                 detail="Video upload failed"
             )
 
-    @router.get("/videos")
-    async def get_user_videos(
-        request: Request,
+    @router.get("/videos", response_model=VideoListResponse, response_model_exclude_none=True)
+    def get_user_videos(
         limit: int = 50,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get user's videos"""
+        # Get videos from Supabase (only source), already ordered
+        # newest-first and limited by the query
         try:
-            videos = []
-            video_ids_seen = set()  # Track video IDs to avoid duplicates
-            
-            # Get videos from Supabase (only source)
-            try:
-                supabase_videos = supabase_client.get_user_videos(current_user.id, limit)
-                for video in supabase_videos:
-                    video_id = video.get('id')
-                    if video_id and video_id not in video_ids_seen:
-                        videos.append(video)
-                        video_ids_seen.add(video_id)
-                logger.info(f"Loaded {len(videos)} videos from Supabase")
-            except Exception as e:
-                logger.error(f"Could not fetch videos from Supabase: {e}")
-                # Return empty list if Supabase fetch fails
-                videos = []
-              # Sort by created_at and limit
-            videos = sorted(videos, key=lambda x: x.get('created_at', ''), reverse=True)[:limit]
-            
-            logger.info(f"Returning {len(videos)} videos to user")
-            return {"videos": videos}
-            
+            videos = supabase_client.get_user_videos(current_user.id, limit)
+            logger.debug(f"Loaded {len(videos)} videos from Supabase")
+            # The dashboard plays file_url directly, so hand out URLs that
+            # are still valid, signed in bulk (and cached) for the whole page
+            urls = supabase_client.refresh_video_urls([
+                video["id"] for video in videos if video.get("storage_provider") == "supabase"
+            ])
+            for video in videos:
+                if video["id"] in urls:
+                    video["file_url"] = urls[video["id"]]
         except Exception as e:
-            logger.error(f"Error getting user videos: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve videos"
-            )
+            logger.error(f"Could not fetch videos from Supabase: {e}")
+            # Return empty list if Supabase fetch fails
+            videos = []
+        
+        logger.debug(f"Returning {len(videos)} videos to user")
+        return {"videos": videos}
 
     @router.get("/videos/{video_id}")
-    async def get_video(
+    def get_video(
         video_id: str,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get video details"""
-        try:
-            video = supabase_client.get_video(video_id)
-            
-            if not video:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Video not found"
-                )
-            
-            if video["user_id"] != current_user.id:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Access denied"
-                )
-            
-            return video
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error getting video: {e}")
+        video = supabase_client.get_video_for_user(video_id, current_user.id)
+        
+        if not video:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve video"
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video not found"
             )
+        
+        return video
 
     @router.get("/videos/{video_id}/analysis")
     async def get_video_analysis(
@@ -246,144 +363,74 @@ def create_api_router() -> APIRouter:
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get video analysis results"""
-        try:
-            video_processor = request.app.state.video_processor
-            analysis = await video_processor.get_video_analysis(video_id, current_user.id)
-            return analysis
-            
-        except Exception as e:
-            logger.error(f"Error getting video analysis: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve video analysis"
-            )
+        video_processor = request.app.state.video_processor
+        analysis = await video_processor.get_video_analysis(video_id, current_user.id)
+        return analysis
     
     @router.get("/videos/{video_id}/stream")
     async def stream_video(
         video_id: str,
-        request: Request,
-        token: Optional[str] = None
+        current_user: AuthUser = Depends(get_user_from_header_or_query)
     ):
         """Stream video file"""
-        try:
-            from fastapi.responses import FileResponse
-            from fastapi.security import HTTPAuthorizationCredentials
-            
-            # Get current user either from auth header or token query param
-            current_user = None
-            
-            if token:
-                # Use token from query parameter
-                try:
-                    # Create credentials object for get_current_user
-                    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
-                    current_user = await get_current_user(credentials)
-                except Exception as e:
-                    logger.error(f"Token validation error: {e}")
-                    raise HTTPException(
-                        status_code=status.HTTP_401_UNAUTHORIZED,
-                        detail="Invalid token"
-                    )
-            else:
-                # Try to get from Authorization header
-                auth_header = request.headers.get("authorization")
-                if auth_header and auth_header.startswith("Bearer "):
-                    token_from_header = auth_header.split(" ")[1]
-                    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token_from_header)
-                    current_user = await get_current_user(credentials)
-                else:
-                    raise HTTPException(
-                        status_code=status.HTTP_401_UNAUTHORIZED,
-                        detail="Authentication required"
-                    )
-            
-            # Get video details
-            video = supabase_client.get_video(video_id)
-            
-            if not video:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Video not found"
-                )
-            
-            if video["user_id"] != current_user.id:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Access denied"
-                )              # Check if we have a Supabase Storage URL
-            storage_provider = video.get("storage_provider")
-            file_url = video.get("file_url") 
-            file_path = video.get("file_path")
-            
-            if storage_provider == "supabase" and file_url:
-                # If we have a Supabase Storage URL, redirect to it
-                from fastapi.responses import RedirectResponse
-                
-                # For expired URLs, generate a fresh signed URL
-                if "token_has_expired" in file_url or "error" in file_url.lower():
-                    try:
-                        # Parse the storage path from file_path (format: "bucket/path")
-                        storage_parts = file_path.split('/', 1)
-                        if len(storage_parts) == 2:
-                            bucket = storage_parts[0]
-                            path = storage_parts[1]
-                            
-                            # Generate a new signed URL
-                            fresh_url = supabase_client.get_admin_client().storage.from_(bucket).create_signed_url(
-                                path=path,
-                                expires_in=3600  # 1 hour
-                            )
-                            
-                            # Update the video record with the new URL
-                            supabase_client.get_admin_client().table("videos").update({
-                                "file_url": fresh_url
-                            }).eq("id", video_id).execute()
-                            
-                            file_url = fresh_url
-                    except Exception as e:
-                        logger.error(f"Failed to refresh signed URL: {e}")
-                
-                logger.info(f"Redirecting to Supabase Storage URL for video {video_id}")
-                return RedirectResponse(url=file_url)
-            
-            # Fall back to local file if no storage provider or URL (for backward compatibility)
-            if not file_path:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Video file path not found"
-                )
-            
-            logger.warning(f"Using local file fallback for video {video_id}. Consider migrating this to Supabase Storage.")
-            
-            # If path is relative, make it relative to backend directory
-            if not os.path.isabs(file_path):
-                # Get the directory where this script is located (backend/)
-                backend_dir = os.path.dirname(os.path.abspath(__file__))
-                file_path = os.path.join(backend_dir, file_path)
-            
-            if not os.path.exists(file_path):
-                logger.error(f"Video file not found at path: {file_path}")
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Video file not found on disk"
-                )
-                
-            # Return video file from disk (legacy method)
-            from fastapi.responses import FileResponse
-            return FileResponse(
-                path=file_path,
-                media_type="video/mp4",
-                filename=video.get("original_name", "video.mp4")
+        # Get video details (scoped to the caller, so others' videos 404)
+        video = await asyncio.to_thread(supabase_client.get_video_for_user, video_id, current_user.id)
+        
+        if not video:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video not found"
             )
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error streaming video: {e}")
+
+        # Check if we have a Supabase Storage URL
+        storage_provider = video.get("storage_provider")
+        file_url = video.get("file_url") 
+        file_path = video.get("file_path")
+        
+        if storage_provider == "supabase" and file_url:
+            # If we have a Supabase Storage URL, redirect to it. The signed
+            # URL goes through the same cache as the video list, so a player
+            # reuses the URL the list just handed out instead of re-signing.
+            fresh_urls = await asyncio.to_thread(supabase_client.refresh_video_urls, [video_id])
+            file_url = fresh_urls.get(video_id, file_url)
+            
+            logger.debug(f"Redirecting to Supabase Storage URL for video {video_id}")
+            return RedirectResponse(url=file_url)
+        
+        # Fall back to local file if no storage provider or URL (for backward compatibility)
+        if not file_path:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to stream video"
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video file path not found"
             )
+        
+        logger.warning(f"Using local file fallback for video {video_id}. Consider migrating this to Supabase Storage.")
+        
+        # If path is relative, make it relative to backend directory
+        if not os.path.isabs(file_path):
+            # Get the directory where this script is located (backend/)
+            backend_dir = os.path.dirname(os.path.abspath(__file__))
+            file_path = os.path.join(backend_dir, file_path)
+        
+        # Stat once off the event loop; FileResponse reuses the result
+        # instead of statting the file again on send
+        try:
+            stat_result = await asyncio.to_thread(os.stat, file_path)
+        except FileNotFoundError:
+            logger.error(f"Video file not found at path: {file_path}")
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video file not found on disk"
+            )
+            
+        # Return video file from disk (legacy method)
+        return FileResponse(
+            path=file_path,
+            media_type="video/mp4",
+            filename=video.get("original_name", "video.mp4"),
+            stat_result=stat_result,
+            headers={"Cache-Control": "private, max-age=3600"}
+        )
 
     @router.post("/videos/{video_id}/process")
     async def process_video(
@@ -392,238 +439,157 @@ def create_api_router() -> APIRouter:
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Trigger video processing with real AI analysis"""
-        try:
-            logger.info(f"Processing video {video_id} for user {current_user.id}")
-            
-            # Get video processor from app state
-            video_processor = request.app.state.video_processor
-            
-            # First, check if video exists in Supabase database
-            video_record = supabase_client.get_video(video_id)
-            
-            if video_record:
-                # Check ownership
-                if video_record.get('user_id') != current_user.id:
-                    raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN,
-                        detail="Access denied"
-                    )
+        logger.info(f"Processing video {video_id} for user {current_user.id}")
+        
+        # Get video processor from app state
+        video_processor = request.app.state.video_processor
+        
+        # First, check if video exists in Supabase database
+        video_record = await asyncio.to_thread(supabase_client.get_video_for_user, video_id, current_user.id)
+        
+        if video_record:
+            # Check if already processed
+            if video_record.get('upload_status') == 'completed':
+                return {
+                    "status": "completed",
+                    "message": "Video already processed",
+                    "video_id": video_id
+                }
+            
+            # Get file path and check if file exists (filesystem, DB and the
+            # metadata probe all block, so they run off the event loop)
+            file_path = video_record.get('file_path')
+            if file_path and await asyncio.to_thread(os.path.exists, file_path):
+                # Update status to processing in database
+                await asyncio.to_thread(supabase_client.update_video_status, video_id, "processing")
                 
-                # Check if already processed
-                if video_record.get('upload_status') == 'completed':
-                    return {
-                        "status": "completed",
-                        "message": "Video already processed",
-                        "video_id": video_id
-                    }
+                # Create metadata object
+                metadata = await asyncio.to_thread(VideoMetadata, file_path)
                 
-                # Get file path and check if file exists
-                file_path = video_record.get('file_path')
-                if file_path and os.path.exists(file_path):
-                    # Update status to processing in database
-                    supabase_client.update_video_status(video_id, "processing")
-                    
-                    # Create metadata object
-                    from backend.video_processor import VideoMetadata
-                    metadata = VideoMetadata(file_path)
-                    
-                    # Add to processing queue for real AI analysis
-                    await video_processor.processing_queue.put({
-                        "video_id": video_id,
-                        "user_id": current_user.id,
-                        "filepath": file_path,
-                        "metadata": metadata,
-                        "cleanup_dir": None  # No cleanup needed for existing files
-                    })
-                      # Start processing if not already running
-                    if not video_processor.is_processing:
-                        asyncio.create_task(video_processor._process_queue())
-                    
-                    logger.info(f"Video {video_id} added to processing queue for real AI analysis")
-                    return {
-                        "status": "processing",
-                        "message": "Video processing started with real AI analysis",
-                        "video_id": video_id
-                    }
-                else:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail="Video file not found on disk"
-                    )
+                # Add to processing queue for real AI analysis
+                await video_processor.processing_queue.put({
+                    "video_id": video_id,
+                    "user_id": current_user.id,
+                    "filepath": file_path,
+                    "metadata": metadata,
+                    "cleanup_dir": None  # No cleanup needed for existing files
+                })
+                  # Start processing if not already running
+                if not video_processor.is_processing:
+                    asyncio.create_task(video_processor._process_queue())
+                
+                logger.info(f"Video {video_id} added to processing queue for real AI analysis")
+                return {
+                    "status": "processing",
+                    "message": "Video processing started with real AI analysis",
+                    "video_id": video_id
+                }
             else:
-                # Video not found in database
-                logger.error(f"Video {video_id} not found in database")
                 raise HTTPException(
                     status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Video not found"
+                    detail="Video file not found on disk"
                 )
-                
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error processing video: {e}")
+        else:
+            # Video not found in database
+            logger.error(f"Video {video_id} not found in database")
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to process video"
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video not found"
             )
 
     @router.delete("/videos/{video_id}")
     async def delete_video(
         video_id: str,
-        request: Request,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Delete a video"""
-        try:
-            video_found = False
-            
-            logger.info(f"Attempting to delete video {video_id} for user {current_user.id}")
-            
-            # Delete from Supabase (only source)
-            try:
-                video = supabase_client.get_video(video_id)
-                if video:
-                    logger.info(f"Found video in Supabase: {video}")
-                    if video["user_id"] != current_user.id:
-                        raise HTTPException(
-                            status_code=status.HTTP_403_FORBIDDEN,
-                            detail="Access denied"
-                        )
-                    
-                    # Delete associated events first (to avoid foreign key constraint issues)
-                    try:
-                        admin_client = supabase_client.get_admin_client()
-                        events_result = admin_client.table("events").delete().eq("video_id", video_id).execute()
-                        deleted_events = len(events_result.data) if events_result.data else 0
-                        logger.info(f"Deleted {deleted_events} events associated with video {video_id}")
-                    except Exception as e:
-                        logger.warning(f"Could not delete events for video {video_id}: {e}")
-                    
-                    # Delete from storage
-                    try:
-                        supabase_client.delete_file("videos", video["file_path"])
-                    except Exception as e:
-                        logger.warning(f"Could not delete file from storage: {e}")
-                    
-                    # Delete from database
-                    admin_client = supabase_client.get_admin_client()
-                    admin_client.table("videos").delete().eq("id", video_id).execute()
-                    video_found = True
-                    logger.info(f"Deleted video {video_id} from Supabase")
-                else:
-                    logger.info(f"Video {video_id} not found in Supabase")
-            except Exception as e:
-                logger.error(f"Could not delete from Supabase: {e}")
-            
-            if not video_found:
-                logger.error(f"Video {video_id} not found")
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Video not found"
-                )
-            
-            return {"message": "Video deleted successfully"}
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error deleting video: {e}")
+        logger.info(f"Attempting to delete video {video_id} for user {current_user.id}")
+
+        # Events + video row go in one ownership-scoped RPC; only the
+        # storage object needs a second call
+        deleted = await asyncio.to_thread(
+            supabase_client.delete_video_cascade, video_id, current_user.id
+        )
+        if not deleted:
+            logger.error(f"Video {video_id} not found")
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to delete video"
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video not found"
+            )
+        logger.info(f"Deleted video {video_id} from Supabase")
+
+        # The storage object is orphaned once the row is gone and a
+        # failed delete is only logged, so don't hold the response for it
+        if deleted.get("file_path"):
+            task = asyncio.create_task(
+                asyncio.to_thread(supabase_client.delete_file, "videos", deleted["file_path"])
             )
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        
+        return {"message": "Video deleted successfully"}
     
     # Event management routes
-    @router.get("/events")
-    async def get_user_events(
-        request: Request,
+    @router.get("/events", response_model=EventListResponse, response_model_exclude_none=True)
+    def get_user_events(
         limit: int = 100,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get user's anomaly detection events"""
+        events = []
+        
+        # Get events from Supabase (only source), already ordered
+        # newest-first and limited by the query
         try:
-            events = []
-            
-            # Get events from Supabase (only source)
-            try:
-                supabase_events = supabase_client.get_user_events(current_user.id, limit)
-                events.extend(supabase_events)
-                logger.info(f"Loaded {len(supabase_events)} events from Supabase")
-            except Exception as e:
-                logger.error(f"Could not fetch events from Supabase: {e}")
-            
-            # Sort events by timestamp
-            events = sorted(events, key=lambda x: x.get('created_at', ''), reverse=True)[:limit]
-            
-            logger.info(f"Returning {len(events)} events to user")
-            return {"events": events}
+            events = supabase_client.get_user_events(current_user.id, limit)
+            logger.debug(f"Loaded {len(events)} events from Supabase")
         except Exception as e:
-            logger.error(f"Error getting user events: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve events"
-            )
+            logger.error(f"Could not fetch events from Supabase: {e}")
+        
+        logger.debug(f"Returning {len(events)} events to user")
+        return {"events": events}
     
-    @router.get("/videos/{video_id}/events")
-    async def get_video_events(
+    @router.get("/videos/{video_id}/events", response_model=EventListResponse, response_model_exclude_none=True)
+    def get_video_events(
         video_id: str,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get events for a specific video"""
-        try:
-            # Verify video ownership
-            video = supabase_client.get_video(video_id)
-            if not video or video["user_id"] != current_user.id:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Access denied"
-                )
-            
-            events = supabase_client.get_video_events(video_id)
-            return {"events": events}
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error getting video events: {e}")
+        # Verify video ownership
+        if not supabase_client.user_owns_video(video_id, current_user.id):
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve events"            )
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Video not found"
+            )
+        
+        events = supabase_client.get_video_events(video_id)
+        return {"events": events}
     
     @router.put("/events/{event_id}")
-    async def update_event(
+    def update_event(
         event_id: str,
         data: EventUpdateRequest,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Update an event (e.g., mark as false positive, edit description)"""
-        try:
-            admin_client = supabase_client.get_admin_client()
+        admin_client = supabase_client.get_admin_client()
 
-            existing = admin_client.table("events").select("id, user_id").eq("id", event_id).execute()
-            if not existing.data:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Event not found")
-            if existing.data[0]["user_id"] != current_user.id:
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
+        existing = admin_client.table("events").select("id, user_id").eq("id", event_id).execute()
+        if not existing.data:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Event not found")
+        if existing.data[0]["user_id"] != current_user.id:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
 
-            update_data = {k: v for k, v in data.dict().items() if v is not None}
-            if not update_data:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields to update")
+        update_data = data.model_dump(exclude_none=True)
+        if not update_data:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields to update")
 
-            result = admin_client.table("events").update(update_data).eq("id", event_id).execute()
-            if not result.data:
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to update event")
+        result = admin_client.table("events").update(update_data).eq("id", event_id).execute()
+        if not result.data:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to update event")
 
-            logger.info(f"Updated event {event_id} with {update_data}")
-            return {"message": "Event updated successfully", "event_id": event_id, "event": result.data[0]}
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error updating event: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to update event"
-            )
+        logger.info(f"Updated event {event_id} with {update_data}")
+        return {"message": "Event updated successfully", "event_id": event_id, "event": result.data[0]}
 
     @router.post("/events/{event_id}/feedback")
     async def provide_feedback(
@@ -633,28 +599,19 @@ def create_api_router() -> APIRouter:
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Provide feedback on an anomaly detection"""
-        try:
-            video_processor = request.app.state.video_processor
-            success = await video_processor.provide_feedback(
-                event_id=event_id,
-                user_id=current_user.id,
-                is_false_positive=feedback.is_false_positive,
-                feedback_score=feedback.feedback_score
-            )
-            
-            if success:
-                return {"message": "Feedback recorded successfully"}
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Failed to record feedback"
-                )
-                
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error providing feedback: {e}")
-            raise HTTPException(                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        video_processor = request.app.state.video_processor
+        success = await video_processor.provide_feedback(
+            event_id=event_id,
+            user_id=current_user.id,
+            is_false_positive=feedback.is_false_positive,
+            feedback_score=feedback.feedback_score
+        )
+        
+        if success:
+            return {"message": "Feedback recorded successfully"}
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Failed to record feedback"
             )
     
@@ -662,77 +619,42 @@ def create_api_router() -> APIRouter:
     @router.get("/system/status")
     async def get_system_status(request: Request, current_user: AuthUser = Depends(get_current_user)):
         """Get system status and metrics"""
-        try:
-            video_processor = request.app.state.video_processor
-            system_status = video_processor.get_system_status()
-            return system_status
-        except Exception as e:
-            logger.error(f"Error getting system status: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve system status"
-            )
+        video_processor = request.app.state.video_processor
+        system_status = video_processor.get_system_status()
+        return system_status
 
     @router.get("/system/metrics")
     async def get_system_metrics(request: Request, current_user: AuthUser = Depends(get_current_user)):
         """Get detailed system metrics"""
-        try:
-            # Get video processor statistics
-            video_processor = request.app.state.video_processor
-            processor_status = video_processor.get_system_status()
-
-            return {
-                "video_processor": processor_status,
-                "timestamp": datetime.utcnow().isoformat() + "Z"
-            }
-
-        except Exception as e:
-            logger.error(f"Error getting system metrics: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve system metrics"
-            )
+        # Get video processor statistics
+        video_processor = request.app.state.video_processor
+        processor_status = video_processor.get_system_status()
+
+        return {
+            "video_processor": processor_status,
+            "timestamp": datetime.utcnow().isoformat() + "Z"
+        }
     
-    @router.get("/system/events")
-    async def get_system_events(
+    @router.get("/system/events", response_model=EventListResponse, response_model_exclude_none=True)
+    def get_system_events(
         limit: int = 100,
         event_type: Optional[str] = None,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get system events for the user"""
-        try:
-            # Get events from Supabase instead of EventStream
-            events = supabase_client.get_user_events(current_user.id, limit)
-            
-            # Filter by event_type if provided
-            if event_type:
-                events = [e for e in events if e.get('event_type') == event_type]
-            
-            return {"events": events}
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error getting system events: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve system events"
-            )
+        # Get events from Supabase instead of EventStream; the event_type
+        # filter is applied in the query so the limit counts matching rows
+        events = supabase_client.get_user_events(current_user.id, limit, event_type)
+        
+        return {"events": events}
     
     # RL Controller routes
     @router.get("/rl/status")
     async def get_rl_status(request: Request, current_user: AuthUser = Depends(get_current_user)):
         """Get RL controller status"""
-        try:
-            video_processor = request.app.state.video_processor
-            rl_summary = video_processor.rl_controller.get_training_summary()
-            return rl_summary
-        except Exception as e:
-            logger.error(f"Error getting RL status: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve RL status"
-            )
+        video_processor = request.app.state.video_processor
+        rl_summary = video_processor.rl_controller.get_training_summary()
+        return rl_summary
 
     @router.post("/rl/reset")
     async def reset_rl_training(request: Request, current_user: AuthUser = Depends(get_current_user)):
@@ -742,16 +664,9 @@ def create_api_router() -> APIRouter:
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Only system administrators can reset RL training"
             )
-        try:
-            video_processor = request.app.state.video_processor
-            video_processor.rl_controller.reset()
-            return {"message": "RL training reset successfully"}
-        except Exception as e:
-            logger.error(f"Error resetting RL training: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to reset RL training"
-            )
+        video_processor = request.app.state.video_processor
+        video_processor.rl_controller.reset()
+        return {"message": "RL training reset successfully"}
 
     # RAG System routes
     @router.get("/rag/patterns")
@@ -761,134 +676,65 @@ def create_api_router() -> APIRouter:
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get RAG system patterns summary"""
-        try:
-            video_processor = request.app.state.video_processor
-            summary = video_processor.rag_system.generate_pattern_summary(pattern_type)
-            return summary
-        except Exception as e:
-            logger.error(f"Error getting RAG patterns: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve RAG patterns"
-            )
+        video_processor = request.app.state.video_processor
+        summary = video_processor.rag_system.generate_pattern_summary(pattern_type)
+        return summary
 
     @router.get("/rag/stats")
     async def get_rag_stats(request: Request, current_user: AuthUser = Depends(get_current_user)):
         """Get RAG system statistics"""
-        try:
-            video_processor = request.app.state.video_processor
-            stats = video_processor.rag_system.get_pattern_stats()
-            return stats
-        except Exception as e:
-            logger.error(f"Error getting RAG stats: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to retrieve RAG statistics"
-            )
+        video_processor = request.app.state.video_processor
+        stats = video_processor.rag_system.get_pattern_stats()
+        return stats
     
     # User Settings routes
     @router.get("/settings", response_model=UserSettings)
-    async def get_user_settings(current_user: AuthUser = Depends(get_current_user)):
+    def get_user_settings(
+        request: Request,
+        current_user: AuthUser = Depends(get_current_user)
+    ):
         """Get user settings"""
         try:
             # Get settings from Supabase using admin client
             admin_client = supabase_client.get_admin_client()
-            result = admin_client.table("user_settings").select("*").eq("user_id", current_user.id).execute()
+            result = admin_client.table("user_settings").select(USER_SETTINGS_COLUMNS).eq("user_id", current_user.id).execute()
             
-            if result.data and len(result.data) > 0:
-                settings_data = result.data[0]
-                return UserSettings(
-                    anomaly_threshold=settings_data.get('anomaly_threshold', 0.5),
-                    frame_sampling_rate=settings_data.get('frame_sampling_rate', 10),
-                    auto_delete_old_videos=settings_data.get('auto_delete_old_videos', False),
-                    video_retention_days=settings_data.get('video_retention_days', 30)
-                )
-            else:
-                # Return default settings
-                return UserSettings()
+            # Default settings when the user has not saved any yet
+            payload = _settings_payload(result.data[0]) if result.data else _DEFAULT_SETTINGS_PAYLOAD
                 
         except Exception as e:
             logger.error(f"Error getting user settings: {e}")
-            # Return default settings on error
-            return UserSettings()
+            # Return default settings on error (untagged, so it isn't revalidated against)
+            return ORJSONResponse(_DEFAULT_SETTINGS_PAYLOAD)
+
+        return _settings_response(payload, request.headers.get("if-none-match"))
     
     @router.put("/settings", response_model=UserSettings)
-    async def update_user_settings(
+    def update_user_settings(
         settings: SettingsUpdateRequest,
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Update user settings"""
-        try:
-            # Prepare update data
-            update_data = {"user_id": current_user.id}
-            
-            if settings.anomaly_threshold is not None:
-                if not (0 <= settings.anomaly_threshold <= 1):                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="Anomaly threshold must be between 0 and 1"
-                    )
-                update_data["anomaly_threshold"] = settings.anomaly_threshold
-            
-            if settings.frame_sampling_rate is not None:
-                if settings.frame_sampling_rate <= 0:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="Frame sampling rate must be positive"
-                    )
-                update_data["frame_sampling_rate"] = settings.frame_sampling_rate
-            
-            if settings.auto_delete_old_videos is not None:
-                update_data["auto_delete_old_videos"] = settings.auto_delete_old_videos
-            
-            if settings.video_retention_days is not None:
-                if settings.video_retention_days <= 0:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="Video retention days must be positive"
-                    )
-                update_data["video_retention_days"] = settings.video_retention_days
-            
-            # Update settings in Supabase using admin client to bypass RLS
-            admin_client = supabase_client.get_admin_client()
-            
-            logger.info(f"Updating settings for user {current_user.id}: {update_data}")
-            
-            # First try to update existing record
-            result = admin_client.table("user_settings").update(
-                {k: v for k, v in update_data.items() if k != "user_id"}
-            ).eq("user_id", current_user.id).execute()
-            
-            # If no rows were updated, insert a new record
-            if not result.data:
-                logger.info(f"No existing settings found, inserting new record for user {current_user.id}")
-                result = admin_client.table("user_settings").insert(
-                    update_data
-                ).execute()
-            else:
-                logger.info(f"Updated existing settings for user {current_user.id}")
-            
-            if result.data:
-                settings_data = result.data[0]
-                return UserSettings(
-                    anomaly_threshold=settings_data.get('anomaly_threshold', 0.5),
-                    frame_sampling_rate=settings_data.get('frame_sampling_rate', 10),
-                    auto_delete_old_videos=settings_data.get('auto_delete_old_videos', False),
-                    video_retention_days=settings_data.get('video_retention_days', 30)
-                )
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Failed to update settings"
-                )
-                
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error updating user settings: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to update settings"
-            )
+        # Range checks live on SettingsUpdateRequest; only the fields sent are written
+        update_data = settings.model_dump(exclude_none=True)
+        update_data["user_id"] = current_user.id
+        
+        # Update settings in Supabase using admin client to bypass RLS
+        admin_client = supabase_client.get_admin_client()
+        
+        logger.info(f"Updating settings for user {current_user.id}: {update_data}")
+        
+        # Single INSERT ... ON CONFLICT (user_id) DO UPDATE: only the columns
+        # sent are updated, and a first save still gets the column defaults.
+        # The stored row is still returned (it carries the fields not sent),
+        # projected onto the response columns like the GET.
+        query = admin_client.table("user_settings").upsert(
+            update_data, on_conflict="user_id"
+        )
+        query.params = query.params.set("select", USER_SETTINGS_COLUMNS)
+        result = query.execute()
+        
+        return _settings_response(_settings_payload(result.data[0]))
 
     # Video retention cleanup routes
     #
@@ -904,15 +750,8 @@ def create_api_router() -> APIRouter:
         current_user: AuthUser = Depends(get_current_user)
     ):
         """Get preview of videos that would be deleted based on retention settings"""
-        try:
-            preview = await video_cleanup_service.get_cleanup_preview(current_user.id)
-            return preview
-        except Exception as e:
-            logger.error(f"Error getting cleanup preview: {e}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to get cleanup preview"
-            )
+        preview = await video_cleanup_service.get_cleanup_preview(current_user.id)
+        return preview
 
     @router.post("/cleanup/run")
     async def run_video_cleanup(
@@ -931,11 +770,10 @@ def create_api_router() -> APIRouter:
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=str(e)
             )
-        except Exception as e:
-            logger.error(f"Error running video cleanup: {e}")
+        except CleanupBusyError as e:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to run cleanup"
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=str(e)
             )
     
     return router
\ No newline at end of file
@@ -7,11 +7,89 @@ from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import Optional, Union, Dict, Any
+import asyncio
+import hashlib
+from functools import lru_cache
 import os
+import re
+import time
+import httpx
+import jwt
+from cachetools import TLRUCache
 from loguru import logger
 
+from gotrue import SyncGoTrueClient
+
 # Import our custom SupabaseClient
-from backend.autovision_client import SupabaseClient, supabase_client
+from backend.autovision_client import supabase_client, POSTGREST_CLIENT_TIMEOUT
+
+# Connection pool shared by the per-call anon auth clients below. httpx
+# clients are thread-safe, and unlike the gotrue client they keep no session.
+_auth_http_client = httpx.Client(timeout=POSTGREST_CLIENT_TIMEOUT)
+
+# Resolved users are cached per access token for at most AUTH_CACHE_TTL_SECONDS
+# (and never past the token's own exp), so bursts of requests with the same
+# token skip the Supabase auth + profile round-trips.
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", "10000"))
+
+_user_cache: TLRUCache = TLRUCache(
+    maxsize=AUTH_CACHE_MAX_SIZE,
+    ttu=lambda _key, value, now: min(now + AUTH_CACHE_TTL_SECONDS, value[1]),
+    timer=time.time,
+)
+
+
+# Access tokens are checked locally before any network call: HS256 tokens
+# against the project's JWT secret (when configured), asymmetric ones against
+# the project's JWKS, which PyJWKClient fetches once and caches.
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+_jwks_client: Optional[jwt.PyJWKClient] = None
+# Algorithms accepted for JWKS-verified tokens. Fixed here rather than taken
+# from the token header, so a forged "alg" can't pair a JWKS key with HMAC.
+JWKS_ALGORITHMS = ["RS256", "ES256"]
+
+
+def _verify_token_locally(token: str) -> Optional[Dict[str, Any]]:
+    """
+    Verify an access token's signature, expiry and audience without calling
+    Supabase. Returns the claims, or None when no local key is available for
+    the token's algorithm (the RPC then does the verification). Raises for
+    tokens that fail verification. Blocking (the JWKS fetch uses urllib), so
+    async callers run it in a worker thread.
+    """
+    global _jwks_client
+    if jwt.get_unverified_header(token).get("alg") == "HS256":
+        if not SUPABASE_JWT_SECRET:
+            return None
+        return jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience="authenticated")
+
+    if _jwks_client is None:
+        _jwks_client = jwt.PyJWKClient(
+            f"{supabase_client.url}/auth/v1/.well-known/jwks.json", cache_keys=True
+        )
+    try:
+        key = _jwks_client.get_signing_key_from_jwt(token).key
+    except jwt.PyJWKClientConnectionError as e:
+        logger.warning(f"JWKS unavailable, deferring token verification to Supabase: {e}")
+        return None
+    return jwt.decode(token, key, algorithms=JWKS_ALGORITHMS, audience="authenticated")
+
+
+def _token_cache_key(token: str) -> bytes:
+    """Cache key for an access token (the raw JWT is not kept in memory)"""
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def _token_expiry(token: str) -> float:
+    """
+    Read the exp claim without verifying the signature - only used to bound
+    how long an already-verified result is cached. Returns 0 if absent.
+    """
+    try:
+        return float(jwt.decode(token, options={"verify_signature": False}).get("exp", 0))
+    except jwt.PyJWTError:
+        return 0.0
 
 
 def _is_system_admin_email(email: str) -> bool:
@@ -26,6 +104,41 @@ def _is_system_admin_email(email: str) -> bool:
     return email.lower() in allowed
 
 
+# user_profiles columns needed to build an AuthUser
+PROFILE_COLUMNS = "id, email, full_name, avatar_url, is_system_user"
+
+
+# Supabase auth errors are mapped to user-facing messages with one
+# precompiled regex per flow. Each alternative is a set of lookaheads (the
+# keywords may appear in any order); alternatives are tried in priority
+# order and the named group that matched selects the message.
+_SIGNUP_ERROR_RE = re.compile(
+    r"(?P<email_exists>(?=.*email)(?=.*(?:already|exists|registered)))"
+    r"|(?P<weak_password>(?=.*password)(?=.*(?:weak|short|length)))"
+    r"|(?P<invalid_email>(?=.*email)(?=.*invalid))"
+    r"|(?P<user_exists>(?=.*user)(?=.*(?:already|exists)))",
+    re.IGNORECASE | re.DOTALL,
+)
+_SIGNUP_ERROR_DETAILS = {
+    "email_exists": "An account with this email already exists. Please sign in instead.",
+    "weak_password": "Password does not meet requirements. Please use at least 6 characters.",
+    "invalid_email": "Please provide a valid email address.",
+    "user_exists": "An account with this email already exists. Please sign in instead.",
+}
+
+_LOGIN_ERROR_RE = re.compile(
+    r"(?P<bad_credentials>(?=.*invalid)(?=.*(?:password|credentials)))"
+    r"|(?P<unconfirmed>(?=.*email)(?=.*not)(?=.*confirmed))"
+    r"|(?P<rate_limited>(?=.*too many))",
+    re.IGNORECASE | re.DOTALL,
+)
+_LOGIN_ERROR_DETAILS = {
+    "bad_credentials": "Invalid email or password. Please check your credentials and try again.",
+    "unconfirmed": "Please check your email and click the verification link before signing in.",
+    "rate_limited": "Too many login attempts. Please wait a moment and try again.",
+}
+
+
 class AuthUser(BaseModel):
     """Authenticated user model"""
     id: str
@@ -49,7 +162,12 @@ class SignupRequest(BaseModel):
 
 
 class AuthResponse(BaseModel):
-    """Authentication response model"""
+    """Authentication response model
+
+    AuthUser/AuthResponse are filled from Supabase session and profile rows,
+    which are already typed, so they are built with model_construct() to skip
+    re-validation.
+    """
     access_token: str
     refresh_token: str
     user: AuthUser
@@ -58,83 +176,119 @@ class AuthResponse(BaseModel):
 
 # Security scheme
 security = HTTPBearer()
+# Same scheme without the automatic 403, for endpoints that accept the token
+# from another source as well
+optional_security = HTTPBearer(auto_error=False)
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthUser:
-    """Get current authenticated user from JWT token with database validation"""
-    
+async def _resolve_user(token: str) -> Optional[AuthUser]:
+    """
+    Resolve an access token to its user, or None if the token is invalid,
+    expired, revoked or belongs to an unverified account. Never raises, so
+    optional-auth callers don't pay for exception unwinding.
+    """
+    cache_key = _token_cache_key(token)
+    cached = _user_cache.get(cache_key)
+    if cached is not None:
+        return cached[0]
+
+    # Any failure here (including key/algorithm mismatches, which PyJWT
+    # raises as TypeError/ValueError) means the token is invalid
     try:
-        # Get token from credentials
-        token = credentials.credentials
-        
-        # Verify token with Supabase
-        client = supabase_client.get_client()
-        
-        # Get user from token
-        user_response = client.auth.get_user(token)
-        
-        if not user_response.user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid authentication token",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        user = user_response.user
-        
-        # IMPORTANT: Validate user exists in database and is verified
-        # Use admin client to check user profile existence
-        admin_client = supabase_client.get_admin_client()
-        
-        # Check if user exists in user_profiles
-        profile_check = admin_client.table("user_profiles").select("*").eq("id", user.id).execute()
-        
-        if not profile_check.data:
-            logger.warning(f"User {user.email} ({user.id}) not found in user profiles")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User account not found or not verified",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        profile_data = profile_check.data[0]
-        
-        return AuthUser(
-            id=user.id,
-            email=profile_data.get("email", user.email),
-            full_name=profile_data.get("full_name"),
-            avatar_url=profile_data.get("avatar_url"),
-            is_system_user=profile_data.get("is_system_user", False)
-        )
-        
-    except HTTPException:
-        raise
+        claims = await asyncio.to_thread(_verify_token_locally, token)
+    except Exception as e:
+        logger.debug(f"Rejected access token locally: {e}")
+        return None
+
+    try:
+        # Verify the token and load the user's profile in a single RPC
+        profile_data = await asyncio.to_thread(supabase_client.get_profile_for_token, token)
     except Exception as e:
         logger.error(f"Authentication error: {e}")
+        return None
+
+    # IMPORTANT: Validate user exists in database and is verified
+    if not profile_data:
+        return None
+
+    auth_user = AuthUser.model_construct(
+        id=profile_data["id"],
+        email=profile_data["email"],
+        full_name=profile_data.get("full_name"),
+        avatar_url=profile_data.get("avatar_url"),
+        is_system_user=profile_data.get("is_system_user", False)
+    )
+
+    expires_at = float(claims.get("exp", 0)) if claims else _token_expiry(token)
+    if expires_at > time.time():
+        _user_cache[cache_key] = (auth_user, expires_at)
+
+    return auth_user
+
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthUser:
+    """Get current authenticated user from JWT token with database validation"""
+    auth_user = await _resolve_user(credentials.credentials)
+    if auth_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication token or account not verified",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return auth_user
+
+
+async def get_user_from_header_or_query(
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+) -> AuthUser:
+    """
+    Get current user from a ?token= query parameter or the Authorization
+    header, for URLs loaded by media elements that cannot set headers
+    """
+    if token:
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    if not credentials:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
+            detail="Authentication required",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return await get_current_user(credentials)
 
 
-async def get_optional_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> Optional[AuthUser]:
+async def get_optional_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> Optional[AuthUser]:
     """Get current user if authenticated, otherwise return None"""
     if not credentials:
         return None
-    
-    try:
-        return await get_current_user(credentials)
-    except HTTPException:
-        return None
+    return await _resolve_user(credentials.credentials)
 
 
 class AuthService:
     """Authentication service for user management"""
     
     def __init__(self):
-        self.supabase_client = SupabaseClient()
-        self.client = self.supabase_client.get_client()
+        # Reuse the process-wide SupabaseClient (and its admin client) rather
+        # than constructing a second wrapper
+        self.supabase_client = supabase_client
+
+    def _auth_client(self) -> SyncGoTrueClient:
+        """
+        A fresh anon auth client for one sign-up/sign-in/refresh call.
+        These calls store the resulting session on the client they run on,
+        and they run concurrently in worker threads, so sharing one client
+        would let requests overwrite (or sign out) each other's session.
+        Only the lightweight gotrue client is built per call; the HTTP
+        connection pool is shared.
+        """
+        anon_key = self.supabase_client.anon_key
+        return SyncGoTrueClient(
+            url=f"{self.supabase_client.url}/auth/v1",
+            headers={"apiKey": anon_key, "Authorization": f"Bearer {anon_key}"},
+            persist_session=False,
+            auto_refresh_token=False,
+            http_client=_auth_http_client
+        )
     
     async def signup(self, signup_data: SignupRequest) -> Union[AuthResponse, Dict[str, Any]]:
         """Register a new user"""
@@ -143,7 +297,7 @@ class AuthService:
             
             # Sign up user with Supabase - use minimal options to avoid trigger issues
             try:
-                auth_response = self.client.auth.sign_up({
+                auth_response = await asyncio.to_thread(self._auth_client().sign_up, {
                     "email": signup_data.email,
                     "password": signup_data.password
                 })
@@ -194,7 +348,8 @@ class AuthService:
             
             # Create user profile (this now handles duplicates gracefully)
             try:
-                profile = await supabase_client.create_user_profile(
+                profile = await asyncio.to_thread(
+                    supabase_client.create_user_profile,
                     user_id=user.id,
                     email=user.email,
                     full_name=signup_data.full_name,
@@ -209,7 +364,9 @@ class AuthService:
             # Verify the profile was created successfully by querying directly
             admin_client = supabase_client.get_admin_client()
             try:
-                profile_check = admin_client.table("user_profiles").select("*").eq("id", user.id).execute()
+                profile_check = await asyncio.to_thread(
+                    admin_client.table("user_profiles").select(PROFILE_COLUMNS).eq("id", user.id).execute
+                )
                 
                 if not profile_check.data:
                     logger.error(f"Failed to verify user profile for {user.email} ({user.id})")
@@ -232,10 +389,10 @@ class AuthService:
                     "profile_setup_pending": True
                 }
             
-            return AuthResponse(
+            return AuthResponse.model_construct(
                 access_token=session.access_token,
                 refresh_token=session.refresh_token,
-                user=AuthUser(
+                user=AuthUser.model_construct(
                     id=user.id,
                     email=profile_data.get("email", user.email),
                     full_name=profile_data.get("full_name"),
@@ -248,29 +405,17 @@ class AuthService:
         except HTTPException:
             raise
         except Exception as e:
-            logger.error(f"Signup error: {e}")
-            logger.error(f"Signup error type: {type(e).__name__}")
-            logger.error(f"Signup error details: {str(e)}")
+            # Prefer the Supabase-specific message when the error carries one
+            error_message = getattr(e, 'message', None) or str(e)
+            logger.error(f"Signup error ({type(e).__name__}): {error_message}")
             
             # Provide specific error messages based on the error
-            error_message = str(e).lower()
-            
-            # Check for Supabase-specific errors
-            if hasattr(e, 'message'):
-                error_message = str(e.message).lower()
-                logger.error(f"Supabase error message: {e.message}")
-            
-            if "email" in error_message and ("already" in error_message or "exists" in error_message or "registered" in error_message):
-                detail = "An account with this email already exists. Please sign in instead."
-            elif "password" in error_message and ("weak" in error_message or "short" in error_message or "length" in error_message):
-                detail = "Password does not meet requirements. Please use at least 6 characters."
-            elif "email" in error_message and "invalid" in error_message:
-                detail = "Please provide a valid email address."
-            elif "user" in error_message and ("already" in error_message or "exists" in error_message):
-                detail = "An account with this email already exists. Please sign in instead."
+            match = _SIGNUP_ERROR_RE.match(error_message)
+            if match:
+                detail = _SIGNUP_ERROR_DETAILS[match.lastgroup]
             else:
                 # Return the actual error for debugging
-                detail = f"Registration failed: {str(e)}"
+                detail = f"Registration failed: {error_message}"
             
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -281,7 +426,7 @@ class AuthService:
         """Authenticate user and return tokens"""
         try:
             # Sign in with Supabase
-            auth_response = self.client.auth.sign_in_with_password({
+            auth_response = await asyncio.to_thread(self._auth_client().sign_in_with_password, {
                 "email": login_data.email,
                 "password": login_data.password
             })
@@ -300,7 +445,9 @@ class AuthService:
             admin_client = supabase_client.get_admin_client()
             
             # Check if user exists in user_profiles
-            profile_check = admin_client.table("user_profiles").select("*").eq("id", user.id).execute()
+            profile_check = await asyncio.to_thread(
+                admin_client.table("user_profiles").select(PROFILE_COLUMNS).eq("id", user.id).execute
+            )
             
             if not profile_check.data:
                 logger.warning(f"User {user.email} ({user.id}) not found in user profiles during login")
@@ -308,14 +455,17 @@ class AuthService:
                 # Try to create the missing profile (handles orphaned auth users)
                 try:
                     logger.info(f"Attempting to create missing profile for {user.email}")
-                    await supabase_client.create_user_profile(
+                    await asyncio.to_thread(
+                        supabase_client.create_user_profile,
                         user_id=user.id,
                         email=user.email,
                         full_name=user.user_metadata.get("full_name") if user.user_metadata else None,
                         is_system_user=_is_system_admin_email(user.email)
                     )
                     # Re-check if profile was created
-                    profile_check = admin_client.table("user_profiles").select("*").eq("id", user.id).execute()
+                    profile_check = await asyncio.to_thread(
+                        admin_client.table("user_profiles").select(PROFILE_COLUMNS).eq("id", user.id).execute
+                    )
                     
                     if not profile_check.data:
                         raise Exception("Profile creation failed")
@@ -323,9 +473,12 @@ class AuthService:
                     logger.info(f"Successfully created missing profile for {user.email}")
                 except Exception as create_error:
                     logger.error(f"Failed to create missing profile: {create_error}")
-                    # Sign out the user since they shouldn't be allowed to login
+                    # Revoke the session just issued, since they shouldn't be allowed to login
                     try:
-                        self.client.auth.sign_out()
+                        await asyncio.to_thread(
+                            self.supabase_client.get_admin_client().auth.admin.sign_out,
+                            session.access_token
+                        )
                     except:
                         pass
                     raise HTTPException(
@@ -335,10 +488,10 @@ class AuthService:
             
             profile_data = profile_check.data[0]
             
-            return AuthResponse(
+            return AuthResponse.model_construct(
                 access_token=session.access_token,
                 refresh_token=session.refresh_token,
-                user=AuthUser(
+                user=AuthUser.model_construct(
                     id=user.id,
                     email=profile_data.get("email", user.email),
                     full_name=profile_data.get("full_name"),
@@ -351,15 +504,12 @@ class AuthService:
         except HTTPException:
             raise
         except Exception as e:
-            logger.error(f"Login error: {e}")
+            error_message = str(e)
+            logger.error(f"Login error: {error_message}")
             # Provide specific error messages based on the error
-            error_message = str(e).lower()
-            if "invalid" in error_message and ("password" in error_message or "credentials" in error_message):
-                detail = "Invalid email or password. Please check your credentials and try again."
-            elif "email" in error_message and "not" in error_message and "confirmed" in error_message:
-                detail = "Please check your email and click the verification link before signing in."
-            elif "too many" in error_message:
-                detail = "Too many login attempts. Please wait a moment and try again."
+            match = _LOGIN_ERROR_RE.match(error_message)
+            if match:
+                detail = _LOGIN_ERROR_DETAILS[match.lastgroup]
             else:
                 detail = "Login failed. Please check your credentials and try again."
             
@@ -371,7 +521,7 @@ class AuthService:
     async def refresh_token(self, refresh_token: str) -> AuthResponse:
         """Refresh access token"""
         try:
-            auth_response = self.client.auth.refresh_session(refresh_token)
+            auth_response = await asyncio.to_thread(self._auth_client().refresh_session, refresh_token)
             
             if not auth_response.user or not auth_response.session:
                 raise HTTPException(
@@ -387,7 +537,9 @@ class AuthService:
             admin_client = supabase_client.get_admin_client()
             
             # Check if user exists in user_profiles
-            profile_check = admin_client.table("user_profiles").select("*").eq("id", user.id).execute()
+            profile_check = await asyncio.to_thread(
+                admin_client.table("user_profiles").select(PROFILE_COLUMNS).eq("id", user.id).execute
+            )
             
             if not profile_check.data:
                 logger.warning(f"User {user.email} ({user.id}) not found in user profiles during token refresh")
@@ -398,10 +550,10 @@ class AuthService:
             
             profile_data = profile_check.data[0]
             
-            return AuthResponse(
+            return AuthResponse.model_construct(
                 access_token=session.access_token,
                 refresh_token=session.refresh_token,
-                user=AuthUser(
+                user=AuthUser.model_construct(
                     id=user.id,
                     email=profile_data.get("email", user.email),
                     full_name=profile_data.get("full_name"),
@@ -424,10 +576,11 @@ class AuthService:
         """Logout user and invalidate their specific access token"""
         try:
             if access_token:
+                _user_cache.pop(_token_cache_key(access_token), None)
                 # Use the admin API to invalidate this specific token server-side,
                 # rather than sign_out() on the shared anon client (which has no
                 # per-request session and would affect no one's actual token).
-                self.supabase_client.get_admin_client().auth.admin.sign_out(access_token)
+                await asyncio.to_thread(self.supabase_client.get_admin_client().auth.admin.sign_out, access_token)
             return True
         except Exception as e:
             logger.error(f"Logout error: {e}")
@@ -448,15 +601,17 @@ class AuthService:
                 # Server-side update - use the admin client so it isn't
                 # blocked by the "auth.uid() = id" RLS policy (this code
                 # has no user JWT context, only the anon client would).
-                result = (supabase_client.get_admin_client()
-                         .table("user_profiles")
-                         .update(data)
-                         .eq("id", user_id)
-                         .execute())
+                result = await asyncio.to_thread(
+                    supabase_client.get_admin_client()
+                    .table("user_profiles")
+                    .update(data)
+                    .eq("id", user_id)
+                    .execute
+                )
 
                 if result.data:
                     profile = result.data[0]
-                    return AuthUser(
+                    return AuthUser.model_construct(
                         id=profile["id"],
                         email=profile["email"],
                         full_name=profile.get("full_name"),
@@ -465,8 +620,8 @@ class AuthService:
                     )
 
             # Return current profile if no updates
-            profile = supabase_client.get_user_profile(user_id)
-            return AuthUser(
+            profile = await asyncio.to_thread(supabase_client.get_user_profile, user_id)
+            return AuthUser.model_construct(
                 id=user_id,
                 email=profile["email"],
                 full_name=profile.get("full_name"),
@@ -482,5 +637,7 @@ class AuthService:
             )
 
 
-# Global auth service instance
-auth_service = AuthService()
+@lru_cache(maxsize=1)
+def get_auth_service() -> AuthService:
+    """Process-wide AuthService, created on first use (FastAPI dependency)"""
+    return AuthService()
@@ -1,17 +1,89 @@
 """
 Supabase client configuration and utilities for AutoVision
 """
+import base64
 import os
 from typing import Optional, Dict, Any, List
-from supabase import create_client, Client
+from functools import lru_cache
+from supabase import create_client, Client, ClientOptions
+from postgrest.types import ReturnMethod
 from loguru import logger
 import json
-import numpy as np
-from datetime import datetime
 import uuid
 from pathlib import Path
 import tempfile
+import threading
+from contextlib import nullcontext
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
+from cachetools import TTLCache
+
+# Request timeouts (seconds) for the shared clients; storage also carries
+# whole video uploads, so it gets a much longer budget than PostgREST
+POSTGREST_CLIENT_TIMEOUT = float(os.getenv("POSTGREST_CLIENT_TIMEOUT", "10"))
+STORAGE_CLIENT_TIMEOUT = int(os.getenv("STORAGE_CLIENT_TIMEOUT", "120"))
+
+# Videos larger than this are uploaded through Storage's resumable (TUS)
+# endpoint in chunks of RESUMABLE_CHUNK_BYTES (Supabase requires 6MB chunks)
+RESUMABLE_UPLOAD_THRESHOLD_BYTES = 6 * 1024 * 1024
+RESUMABLE_CHUNK_BYTES = 6 * 1024 * 1024
+RESUMABLE_MAX_RETRIES = int(os.getenv("RESUMABLE_MAX_RETRIES", "3"))
+
+# Video ownership cache (see SupabaseClient.user_owns_video)
+VIDEO_OWNER_CACHE_TTL_SECONDS = int(os.getenv("VIDEO_OWNER_CACHE_TTL_SECONDS", "300"))
+VIDEO_OWNER_CACHE_MAX_SIZE = int(os.getenv("VIDEO_OWNER_CACHE_MAX_SIZE", "10000"))
+
+# Bulk-refreshed video URLs are signed for a day and cached for an hour less,
+# so a cached URL always has at least an hour of validity left
+VIDEO_URL_EXPIRES_IN = 86400
+VIDEO_URL_CACHE_TTL_SECONDS = 82800
+
+# Event columns the event list views use; the bbox_* columns and user_id are only
+# needed by per-event detail paths and are left out of list payloads
+EVENT_LIST_COLUMNS = (
+    "id, video_id, event_type, anomaly_score, confidence, timestamp_seconds, frame_number, "
+    "description, explanation, recommendations, is_alert, is_false_positive, created_at"
+)
+
+
+# Optional: per-operation latency histogram, exported on /metrics when
+# prometheus_client is installed
+try:
+    from prometheus_client import Histogram
+    SUPABASE_OP_SECONDS = Histogram(
+        "supabase_op_seconds", "Latency of Supabase requests", ["table", "op"]
+    )
+except ImportError:
+    SUPABASE_OP_SECONDS = None
+
+
+def _op_timer(table: str, op: str):
+    """Time a Supabase request into SUPABASE_OP_SECONDS (no-op when disabled)"""
+    if SUPABASE_OP_SECONDS is None:
+        return nullcontext()
+    return SUPABASE_OP_SECONDS.labels(table, op).time()
+
+
+def bbox_columns(bounding_box: Optional[Dict[str, Any]]) -> Dict[str, Optional[int]]:
+    """Split a detector bounding box ({x, y, width, height}) into events' bbox_* columns"""
+    if not bounding_box:
+        return {"bbox_x": None, "bbox_y": None, "bbox_w": None, "bbox_h": None}
+    return {
+        "bbox_x": int(bounding_box["x"]),
+        "bbox_y": int(bounding_box["y"]),
+        "bbox_w": int(bounding_box["width"]),
+        "bbox_h": int(bounding_box["height"])
+    }
+
+
+@lru_cache(maxsize=2)
+def _get_client(url: str, key: str) -> Client:
+    """One shared Supabase client (and its pooled HTTP sessions) per url/key"""
+    return create_client(url, key, options=ClientOptions(
+        postgrest_client_timeout=POSTGREST_CLIENT_TIMEOUT,
+        storage_client_timeout=STORAGE_CLIENT_TIMEOUT
+    ))
 
 
 class SupabaseClient:
@@ -30,8 +102,24 @@ class SupabaseClient:
         
         try:
             # Initialize two clients - one with anon key and one with service role key
-            self.client: Client = create_client(self.url, self.anon_key)
-            self.admin_client: Client = create_client(self.url, self.service_key)
+            self.client: Client = _get_client(self.url, self.anon_key)
+            self.admin_client: Client = _get_client(self.url, self.service_key)
+            # supabase-py keeps one pooled httpx client per sub-client; the
+            # raw REST calls below (token checks, fallback uploads) share
+            # this keep-alive session likewise, sized for the threadpool
+            self.http = requests.Session()
+            self.http.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+            # A video's owner never changes, so video_id -> user_id is cached
+            # for ownership checks; deletes evict their entry explicitly
+            self._video_owners = TTLCache(maxsize=VIDEO_OWNER_CACHE_MAX_SIZE, ttl=VIDEO_OWNER_CACHE_TTL_SECONDS)
+            self._video_owners_lock = threading.Lock()
+            # video_id -> signed URL from refresh_video_urls
+            self._video_urls = TTLCache(maxsize=VIDEO_OWNER_CACHE_MAX_SIZE, ttl=VIDEO_URL_CACHE_TTL_SECONDS)
+            self._video_urls_lock = threading.Lock()
+            # Storage buckets already verified/created by _ensure_bucket
+            self._known_buckets = set()
+            # Single-request upload methods, the last one that worked first
+            self._upload_methods = [self._upload_with_client, self._upload_with_rest]
             logger.info("Supabase clients initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize Supabase client: {e}")
@@ -49,8 +137,31 @@ class SupabaseClient:
         return self.admin_client
     
     # User Management
-    async def create_user_profile(self, user_id: str, email: str, full_name: Optional[str] = None,
-                                   is_system_user: bool = False) -> Dict[str, Any]:
+    def get_profile_for_token(self, access_token: str) -> Optional[Dict[str, Any]]:
+        """Validate a user access token and fetch its profile in one round-trip
+
+        Calls the get_profile_for_token RPC with the user's own JWT, so
+        PostgREST verifies it. Returns None for invalid, expired or revoked
+        tokens and for users without a profile.
+        """
+        response = self.http.post(
+            f"{self.url}/rest/v1/rpc/get_profile_for_token",
+            headers={
+                "apikey": self.anon_key,
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            },
+            json={},
+            timeout=POSTGREST_CLIENT_TIMEOUT
+        )
+        if response.status_code in (401, 403):
+            return None
+        response.raise_for_status()
+        rows = response.json()
+        return rows[0] if rows else None
+
+    def create_user_profile(self, user_id: str, email: str, full_name: Optional[str] = None,
+                             is_system_user: bool = False) -> Dict[str, Any]:
         """Create or update user profile"""
         try:
             # First, check if a profile with this email already exists
@@ -62,15 +173,14 @@ class SupabaseClient:
                 # If the existing profile has a different user_id, delete it first
                 if existing_id != user_id:
                     logger.warning(f"Profile exists for {email} with different ID ({existing_id}). Deleting old profile.")
-                    self.admin_client.table("user_profiles").delete().eq("email", email).execute()
+                    self.admin_client.table("user_profiles").delete(returning=ReturnMethod.minimal).eq("email", email).execute()
 
                     # Now create new profile
                     data = {
                         "id": user_id,
                         "email": email,
                         "full_name": full_name,
-                        "is_system_user": is_system_user,
-                        "updated_at": datetime.utcnow().isoformat()
+                        "is_system_user": is_system_user
                     }
                     result = self.admin_client.table("user_profiles").insert(data).execute()
                 else:
@@ -79,8 +189,7 @@ class SupabaseClient:
                     # silently reset/escalated on every subsequent login/signup retry)
                     logger.info(f"Updating existing profile for {email}")
                     result = self.admin_client.table("user_profiles").update({
-                        "full_name": full_name,
-                        "updated_at": datetime.utcnow().isoformat()
+                        "full_name": full_name
                     }).eq("id", user_id).execute()
             else:
                 # Create new profile
@@ -88,8 +197,7 @@ class SupabaseClient:
                     "id": user_id,
                     "email": email,
                     "full_name": full_name,
-                    "is_system_user": is_system_user,
-                    "updated_at": datetime.utcnow().isoformat()
+                    "is_system_user": is_system_user
                 }
                 result = self.admin_client.table("user_profiles").insert(data).execute()
 
@@ -109,9 +217,9 @@ class SupabaseClient:
             return None
     
     # Video Management
-    async def create_video_record(self, user_id: str, filename: str, original_name: str, 
-                                file_path: str, file_size: int, duration: Optional[float] = None,
-                                fps: Optional[float] = None, resolution: Optional[str] = None) -> Dict[str, Any]:
+    def create_video_record(self, user_id: str, filename: str, original_name: str, 
+                          file_path: str, file_size: int, duration: Optional[float] = None,
+                          fps: Optional[float] = None, resolution: Optional[str] = None) -> Dict[str, Any]:
         """Create video record in database"""
         try:
             data = {
@@ -127,7 +235,7 @@ class SupabaseClient:
             }
 
             result = self.admin_client.table("videos").insert(data).execute()
-            logger.info(f"Video record created: {filename}")
+            logger.debug(f"Video record created: {filename}")
             return result.data[0] if result.data else {}
         except Exception as e:
             logger.error(f"Error creating video record: {e}")
@@ -140,8 +248,9 @@ class SupabaseClient:
             if metadata:
                 data.update(metadata)
 
-            result = self.admin_client.table("videos").update(data).eq("id", video_id).execute()
-            logger.info(f"Video status updated: {video_id} -> {status}")
+            with _op_timer("videos", "update"):
+                self.admin_client.table("videos").update(data, returning=ReturnMethod.minimal).eq("id", video_id).execute()
+            logger.debug(f"Video status updated: {video_id} -> {status}")
             return True
         except Exception as e:
             logger.error(f"Error updating video status: {e}")
@@ -150,12 +259,13 @@ class SupabaseClient:
     def get_user_videos(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
         """Get user's videos"""
         try:
-            result = (self.admin_client.table("videos")
-                     .select("*")
-                     .eq("user_id", user_id)
-                     .order("created_at", desc=True)
-                     .limit(limit)
-                     .execute())
+            with _op_timer("videos", "select"):
+                result = (self.admin_client.table("videos")
+                         .select("*")
+                         .eq("user_id", user_id)
+                         .order("created_at", desc=True)
+                         .limit(limit)
+                         .execute())
             return result.data or []
         except Exception as e:
             logger.error(f"Error getting user videos: {e}")
@@ -169,12 +279,75 @@ class SupabaseClient:
         except Exception as e:
             logger.error(f"Error getting video: {e}")
             return None
+
+    def get_video_for_user(self, video_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Get video by ID only if it belongs to user_id (None otherwise)"""
+        try:
+            with _op_timer("videos", "select"):
+                result = (self.admin_client.table("videos")
+                         .select("*")
+                         .eq("id", video_id)
+                         .eq("user_id", user_id)
+                         .limit(1)
+                         .execute())
+            if not result.data:
+                return None
+            with self._video_owners_lock:
+                self._video_owners[video_id] = user_id
+            return result.data[0]
+        except Exception as e:
+            logger.error(f"Error getting video: {e}")
+            return None
+
+    def user_owns_video(self, video_id: str, user_id: str) -> bool:
+        """Check video ownership, from the owner cache when possible"""
+        with self._video_owners_lock:
+            owner = self._video_owners.get(video_id)
+        if owner is None:
+            try:
+                result = (self.admin_client.table("videos")
+                         .select("user_id")
+                         .eq("id", video_id)
+                         .limit(1)
+                         .execute())
+            except Exception as e:
+                logger.error(f"Error checking video ownership: {e}")
+                return False
+            if not result.data:
+                return False
+            owner = result.data[0]["user_id"]
+            with self._video_owners_lock:
+                self._video_owners[video_id] = owner
+        return owner == user_id
+
+    def delete_video_cascade(self, video_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Delete a user's video and its events in one call
+
+        Returns the deleted row (with its storage file_path), or None when the
+        video does not exist or is owned by someone else.
+        """
+        result = self.admin_client.rpc("delete_video_cascade", {
+            "vid": video_id,
+            "uid": user_id
+        }).execute()
+        if result.data:
+            self.forget_videos([video_id])
+        return result.data[0] if result.data else None
+
+    def forget_videos(self, video_ids: List[str]):
+        """Evict deleted videos from the ownership and signed-URL caches"""
+        with self._video_owners_lock:
+            for video_id in video_ids:
+                self._video_owners.pop(video_id, None)
+        with self._video_urls_lock:
+            for video_id in video_ids:
+                self._video_urls.pop(video_id, None)
     
     # Event Management
-    async def create_event(self, video_id: str, user_id: str, event_type: str, 
-                          anomaly_score: float, confidence: float, timestamp_seconds: float,
-                          frame_number: int, bounding_box: Optional[Dict] = None,
-                          description: Optional[str] = None, is_alert: bool = False) -> Dict[str, Any]:
+    def create_event(self, video_id: str, user_id: str, event_type: str, 
+                    anomaly_score: float, confidence: float, timestamp_seconds: float,
+                    frame_number: int, bounding_box: Optional[Dict] = None,
+                    description: Optional[str] = None, is_alert: bool = False) -> Dict[str, Any]:
         """Create anomaly detection event"""
         try:
             data = {
@@ -185,41 +358,59 @@ class SupabaseClient:
                 "confidence": confidence,
                 "timestamp_seconds": timestamp_seconds,
                 "frame_number": frame_number,
-                "bounding_box": bounding_box,
+                **bbox_columns(bounding_box),
                 "description": description,
                 "is_alert": is_alert
             }
             
             result = self.admin_client.table("events").insert(data).execute()
-            logger.info(f"Event created: {event_type} at {timestamp_seconds}s")
+            logger.debug(f"Event created: {event_type} at {timestamp_seconds}s")
             return result.data[0] if result.data else {}
         except Exception as e:
             logger.error(f"Error creating event: {e}")
             raise
     
+    def create_events_batch(self, records: List[Dict[str, Any]]) -> bool:
+        """Insert several event rows in a single request"""
+        if not records:
+            return True
+        try:
+            with _op_timer("events", "insert"):
+                self.admin_client.table("events").insert(records, returning=ReturnMethod.minimal).execute()
+            return True
+        except Exception as e:
+            logger.error(f"Error creating events batch ({len(records)} rows): {e}")
+            return False
+    
     def get_video_events(self, video_id: str, limit: int = 100) -> List[Dict[str, Any]]:
         """Get events for a video"""
         try:
-            result = (self.admin_client.table("events")
-                     .select("*")
-                     .eq("video_id", video_id)
-                     .order("timestamp_seconds", desc=False)
-                     .limit(limit)
-                     .execute())
+            with _op_timer("events", "select"):
+                result = (self.admin_client.table("events")
+                         .select("*")
+                         .eq("video_id", video_id)
+                         .order("timestamp_seconds", desc=False)
+                         .limit(limit)
+                         .execute())
             return result.data or []
         except Exception as e:
             logger.error(f"Error getting video events: {e}")
             return []
     
-    def get_user_events(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
-        """Get user's recent events"""
+    def get_user_events(self, user_id: str, limit: int = 100,
+                        event_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Get user's recent events, optionally only those of one event_type"""
         try:
-            result = (self.admin_client.table("events")
-                     .select("*, videos(filename, original_name)")
-                     .eq("user_id", user_id)
-                     .order("created_at", desc=True)
-                     .limit(limit)
-                     .execute())
+            query = (self.admin_client.table("events")
+                     .select(f"{EVENT_LIST_COLUMNS}, videos(filename, original_name)")
+                     .eq("user_id", user_id))
+            if event_type:
+                query = query.eq("event_type", event_type)
+            with _op_timer("events", "select"):
+                result = (query
+                         .order("created_at", desc=True)
+                         .limit(limit)
+                         .execute())
             return result.data or []
         except Exception as e:
             logger.error(f"Error getting user events: {e}")
@@ -228,20 +419,21 @@ class SupabaseClient:
     def update_event_feedback(self, event_id: str, is_false_positive: bool) -> bool:
         """Update event with user feedback"""
         try:
-            result = (self.admin_client.table("events")
-                     .update({"is_false_positive": is_false_positive})
-                     .eq("id", event_id)
-                     .execute())
-            logger.info(f"Event feedback updated: {event_id}")
+            with _op_timer("events", "update"):
+                (self.admin_client.table("events")
+                         .update({"is_false_positive": is_false_positive}, returning=ReturnMethod.minimal)
+                         .eq("id", event_id)
+                         .execute())
+            logger.debug(f"Event feedback updated: {event_id}")
             return True
         except Exception as e:
             logger.error(f"Error updating event feedback: {e}")
             return False
     
     # Logging
-    async def create_log(self, message: str, log_level: str = "INFO", 
-                        user_id: Optional[str] = None, video_id: Optional[str] = None,
-                        event_id: Optional[str] = None, metadata: Optional[Dict] = None) -> bool:
+    def create_log(self, message: str, log_level: str = "INFO", 
+                  user_id: Optional[str] = None, video_id: Optional[str] = None,
+                  event_id: Optional[str] = None, metadata: Optional[Dict] = None) -> bool:
         """Create system log entry"""
         try:
             data = {
@@ -253,17 +445,17 @@ class SupabaseClient:
                 "metadata": metadata
             }
 
-            result = self.admin_client.table("logs").insert(data).execute()
+            self.admin_client.table("logs").insert(data, returning=ReturnMethod.minimal).execute()
             return True
         except Exception as e:
             logger.error(f"Error creating log: {e}")
             return False
 
     # RL Training Data
-    async def save_rl_training_data(self, user_id: str, state_vector: List[float],
-                                   action: int, reward: float,
-                                   next_state_vector: Optional[List[float]] = None,
-                                   done: bool = False) -> bool:
+    def save_rl_training_data(self, user_id: str, state_vector: List[float],
+                             action: int, reward: float,
+                             next_state_vector: Optional[List[float]] = None,
+                             done: bool = False) -> bool:
         """Save RL training data"""
         try:
             data = {
@@ -275,12 +467,24 @@ class SupabaseClient:
                 "done": done
             }
 
-            result = self.admin_client.table("rl_training_data").insert(data).execute()
+            self.admin_client.table("rl_training_data").insert(data, returning=ReturnMethod.minimal).execute()
             return True
         except Exception as e:
             logger.error(f"Error saving RL training data: {e}")
             return False
 
+    def insert_batch(self, table: str, records: List[Dict[str, Any]]) -> bool:
+        """Insert several rows into one table in a single request"""
+        if not records:
+            return True
+        try:
+            with _op_timer(table, "insert"):
+                self.admin_client.table(table).insert(records, returning=ReturnMethod.minimal).execute()
+            return True
+        except Exception as e:
+            logger.error(f"Error inserting {table} batch ({len(records)} rows): {e}")
+            return False
+
     def get_rl_training_data(self, user_id: str, limit: int = 1000) -> List[Dict[str, Any]]:
         """Get RL training data for user"""
         try:
@@ -296,39 +500,21 @@ class SupabaseClient:
             return []
 
     # Historical Patterns for RAG
-    async def save_historical_pattern(self, user_id: str, pattern_type: str,
-                                     embedding: List[float], description: str,
-                                     metadata: Optional[Dict] = None) -> bool:
+    def save_historical_pattern(self, user_id: str, pattern_type: str,
+                               embedding: List[float], description: str,
+                               metadata: Optional[Dict] = None) -> bool:
         """Save historical pattern for RAG"""
         try:
-            # Check if pattern already exists
-            existing = (self.admin_client.table("historical_patterns")
-                       .select("id, frequency_count")
-                       .eq("user_id", user_id)
-                       .eq("pattern_type", pattern_type)
-                       .eq("description", description)
-                       .execute())
-
-            if existing.data:
-                # Update frequency
-                pattern_id = existing.data[0]["id"]
-                new_count = existing.data[0]["frequency_count"] + 1
-                self.admin_client.table("historical_patterns").update({
-                    "frequency_count": new_count,
-                    "last_seen": datetime.utcnow().isoformat()
-                }).eq("id", pattern_id).execute()
-            else:
-                # Create new pattern
-                data = {
-                    "user_id": user_id,
-                    "pattern_type": pattern_type,
-                    "embedding": embedding,
-                    "description": description,
-                    "metadata": metadata,
-                    "frequency_count": 1
-                }
-                self.admin_client.table("historical_patterns").insert(data).execute()
-
+            # Insert-or-bump-frequency in one atomic round trip (see
+            # upsert_historical_pattern in supabase/schema.sql)
+            with _op_timer("historical_patterns", "upsert"):
+                self.admin_client.rpc("upsert_historical_pattern", {
+                    "uid": user_id,
+                    "ptype": pattern_type,
+                    "descr": description,
+                    "emb": embedding,
+                    "meta": metadata
+                }).execute()
             return True
         except Exception as e:
             logger.error(f"Error saving historical pattern: {e}")
@@ -336,39 +522,18 @@ class SupabaseClient:
 
     def search_similar_patterns(self, user_id: str, embedding: List[float],
                                pattern_type: Optional[str] = None, limit: int = 5) -> List[Dict[str, Any]]:
-        """Search for similar historical patterns using cosine similarity on stored embeddings"""
+        """Search for similar historical patterns by cosine similarity of their embeddings"""
         try:
-            query = self.admin_client.table("historical_patterns").select("*").eq("user_id", user_id)
-
-            if pattern_type:
-                query = query.eq("pattern_type", pattern_type)
-
-            # Pull a candidate pool (most frequent first) and rank it by real
-            # cosine similarity against the query embedding in Python, since
-            # this schema doesn't use pgvector for server-side ANN search.
-            result = query.order("frequency_count", desc=True).limit(max(limit * 10, 50)).execute()
-            candidates = result.data or []
-            if not candidates:
-                return []
-
-            query_vec = np.array(embedding, dtype=np.float64)
-            query_norm = np.linalg.norm(query_vec)
-            if query_norm == 0:
-                return candidates[:limit]
-
-            scored = []
-            for pattern in candidates:
-                pattern_embedding = pattern.get("embedding")
-                if not pattern_embedding:
-                    continue
-                vec = np.array(pattern_embedding, dtype=np.float64)
-                if vec.shape != query_vec.shape or np.linalg.norm(vec) == 0:
-                    continue
-                similarity = float(np.dot(query_vec, vec) / (query_norm * np.linalg.norm(vec)))
-                scored.append((similarity, pattern))
-
-            scored.sort(key=lambda item: item[0], reverse=True)
-            return [pattern for _, pattern in scored[:limit]]
+            # Nearest-neighbour search runs in Postgres on the pgvector index
+            # (see match_historical_patterns in supabase/schema.sql)
+            with _op_timer("historical_patterns", "search"):
+                result = self.admin_client.rpc("match_historical_patterns", {
+                    "uid": user_id,
+                    "query_embedding": embedding,
+                    "ptype": pattern_type,
+                    "match_count": limit
+                }).execute()
+            return result.data or []
         except Exception as e:
             logger.error(f"Error searching similar patterns: {e}")
             return []
@@ -405,12 +570,139 @@ class SupabaseClient:
             logger.error(f"Error deleting file: {e}")
             return False    
     # Storage methods
-    async def upload_video_to_storage(self, file_data: bytes, user_id: str, filename: str) -> Dict[str, Any]:
+    def _ensure_bucket(self, bucket_name: str):
+        """
+        Make sure a storage bucket exists, creating it if needed. Checked
+        once per process; create_bucket only returns once the bucket is
+        usable, so no settle delay is needed afterwards.
+        """
+        if bucket_name in self._known_buckets:
+            return
+        try:
+            self.admin_client.storage.get_bucket(bucket_name)
+            logger.info(f"Bucket '{bucket_name}' already exists")
+        except Exception as e:
+            logger.info(f"Bucket '{bucket_name}' not found, creating it. Error: {e}")
+            try:
+                # Create bucket with minimal settings first
+                bucket_response = self.admin_client.storage.create_bucket(bucket_name)
+                logger.info(f"Bucket created successfully: {bucket_response}")
+            except Exception as bucket_error:
+                logger.error(f"Failed to create bucket: {bucket_error}")
+                # Try creating with public access if private fails
+                try:
+                    bucket_response = self.admin_client.storage.create_bucket(
+                        bucket_name, 
+                        {"public": True}
+                    )
+                    logger.info(f"Public bucket created successfully: {bucket_response}")
+                except Exception as public_bucket_error:
+                    logger.error(f"Failed to create public bucket: {public_bucket_error}")
+                    raise Exception(f"Could not create bucket: {public_bucket_error}")
+        self._known_buckets.add(bucket_name)
+
+    def _upload_resumable(self, bucket: str, object_path: str, file_path: str,
+                          content_type: str = "video/mp4"):
+        """
+        Upload a file through Storage's TUS resumable endpoint
+
+        The file is sent in RESUMABLE_CHUNK_BYTES PATCH requests. A failed
+        chunk is retried from the offset the server reports as committed, up
+        to RESUMABLE_MAX_RETRIES consecutive times, so a transient failure
+        never restarts the upload from byte 0.
+        """
+        file_size = os.path.getsize(file_path)
+        headers = {
+            "Authorization": f"Bearer {self.service_key}",
+            "apikey": self.service_key,
+            "Tus-Resumable": "1.0.0"
+        }
+        upload_metadata = {
+            "bucketName": bucket,
+            "objectName": object_path,
+            "contentType": content_type,
+            "cacheControl": "3600"
+        }
+
+        create_response = self.http.post(
+            f"{self.url}/storage/v1/upload/resumable",
+            headers={
+                **headers,
+                "Upload-Length": str(file_size),
+                "Upload-Metadata": ",".join(
+                    f"{key} {base64.b64encode(value.encode()).decode()}"
+                    for key, value in upload_metadata.items()
+                ),
+                "x-upsert": "true"
+            },
+            timeout=POSTGREST_CLIENT_TIMEOUT
+        )
+        if create_response.status_code != 201:
+            raise Exception(f"Resumable upload creation failed: {create_response.status_code} - {create_response.text}")
+        upload_url = urljoin(create_response.url, create_response.headers["Location"])
+
+        offset = 0
+        failures = 0
+        with open(file_path, "rb") as f:
+            while offset < file_size:
+                try:
+                    f.seek(offset)
+                    chunk_response = self.http.patch(
+                        upload_url,
+                        data=f.read(RESUMABLE_CHUNK_BYTES),
+                        headers={
+                            **headers,
+                            "Upload-Offset": str(offset),
+                            "Content-Type": "application/offset+octet-stream"
+                        },
+                        timeout=STORAGE_CLIENT_TIMEOUT
+                    )
+                    if chunk_response.status_code != 204:
+                        raise Exception(f"{chunk_response.status_code} - {chunk_response.text}")
+                    offset = int(chunk_response.headers["Upload-Offset"])
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    if failures > RESUMABLE_MAX_RETRIES:
+                        raise Exception(f"Resumable upload failed at byte {offset}/{file_size}: {e}")
+                    logger.warning(f"Resumable upload chunk at byte {offset} failed, resuming ({failures}/{RESUMABLE_MAX_RETRIES}): {e}")
+                    # Ask the server how much it actually committed
+                    try:
+                        head_response = self.http.head(upload_url, headers=headers, timeout=POSTGREST_CLIENT_TIMEOUT)
+                        offset = int(head_response.headers["Upload-Offset"])
+                    except Exception as head_error:
+                        logger.warning(f"Could not read resumable upload offset, retrying chunk: {head_error}")
+
+    def _upload_with_client(self, bucket: str, object_path: str, file_obj):
+        """Single-request upload through the storage client"""
+        self.admin_client.storage.from_(bucket).upload(
+            path=object_path,
+            file=file_obj,
+            file_options={"content-type": "video/mp4"}
+        )
+
+    def _upload_with_rest(self, bucket: str, object_path: str, file_obj):
+        """Single-request upload straight to the Storage REST API"""
+        response = self.http.post(
+            f"{self.url}/storage/v1/object/{bucket}/{object_path}",
+            data=file_obj,
+            headers={
+                "Authorization": f"Bearer {self.service_key}",
+                "Content-Type": "video/mp4",
+                "x-upsert": "true"
+            },
+            timeout=STORAGE_CLIENT_TIMEOUT
+        )
+        if response.status_code not in (200, 201):
+            raise Exception(f"REST API upload failed: {response.status_code} - {response.text}")
+
+    def upload_video_to_storage(self, file_path: str, user_id: str, filename: str) -> Dict[str, Any]:
         """
         Upload video to Supabase Storage using the correct API format
         
         Args:
-            file_data: Raw video file data
+            file_path: Local path of the video; streamed from disk, never
+                read into memory whole
             user_id: User ID who uploaded the video
             filename: Original filename
             
@@ -425,99 +717,44 @@ class SupabaseClient:
             
             bucket_name = "videos"
             storage_path = f"{user_id}/{storage_filename}"
-              # First, ensure bucket exists with proper configuration
-            try:
-                bucket_info = self.admin_client.storage.get_bucket(bucket_name)
-                logger.info(f"Bucket '{bucket_name}' already exists")
-            except Exception as e:
-                logger.info(f"Bucket '{bucket_name}' not found, creating it. Error: {e}")
-                try:
-                    # Create bucket with minimal settings first
-                    bucket_response = self.admin_client.storage.create_bucket(bucket_name)
-                    logger.info(f"Bucket created successfully: {bucket_response}")
-                except Exception as bucket_error:
-                    logger.error(f"Failed to create bucket: {bucket_error}")
-                    # Try creating with public access if private fails
-                    try:
-                        bucket_response = self.admin_client.storage.create_bucket(
-                            bucket_name, 
-                            {"public": True}
-                        )
-                        logger.info(f"Public bucket created successfully: {bucket_response}")
-                    except Exception as public_bucket_error:
-                        logger.error(f"Failed to create public bucket: {public_bucket_error}")
-                        raise Exception(f"Could not create bucket: {public_bucket_error}")
-            
-            # Wait a moment for bucket to be fully created
-            import time
-            time.sleep(1)
+            # First, ensure bucket exists with proper configuration
+            self._ensure_bucket(bucket_name)
             
             logger.info(f"Uploading to Supabase Storage: {storage_path}")
             
-            # Try the BytesIO method first (most likely to work)
-            from io import BytesIO
-            
-            # Create a BytesIO object that mimics a file
-            file_buffer = BytesIO(file_data)
-            file_buffer.name = storage_filename  # This is crucial for the API
-            
-            response = None
             upload_successful = False
             
-            try:
-                response = self.admin_client.storage.from_(bucket_name).upload(
-                    path=storage_path,
-                    file=file_buffer,
-                    file_options={"content-type": "video/mp4"}
-                )
-                upload_successful = True
-                logger.info("Upload successful with BytesIO method")
-                
-            except Exception as e1:
-                logger.warning(f"BytesIO method failed: {e1}")
-                
-                # If BytesIO fails, try direct REST API with corrected URL
+            # Large videos go through the resumable (TUS) endpoint, so a
+            # network blip costs one chunk rather than the whole upload; the
+            # single-request methods below cover small files and TUS failures
+            if os.path.getsize(file_path) > RESUMABLE_UPLOAD_THRESHOLD_BYTES:
                 try:
-                    import json
-                    
-                    # Get the storage URL and credentials
-                    supabase_url = os.getenv("SUPABASE_URL")
-                    service_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-                    
-                    # Correct REST API endpoint format
-                    upload_url = f"{supabase_url}/storage/v1/object/{bucket_name}/{storage_path}"
-                    
-                    headers = {
-                        "Authorization": f"Bearer {service_key}",
-                        "Content-Type": "video/mp4",
-                        "x-upsert": "true"
-                    }
-                    
-                    logger.info(f"Trying REST API upload to: {upload_url}")
-                    
-                    # Direct REST API upload
-                    rest_response = requests.post(
-                        upload_url,
-                        data=file_data,
-                        headers=headers
-                    )
-                    
-                    logger.info(f"REST API response status: {rest_response.status_code}")
-                    logger.debug(f"REST API response: {rest_response.text}")
-                    
-                    if rest_response.status_code in [200, 201]:
-                        response = rest_response.json() if rest_response.text else {"success": True}
-                        upload_successful = True
-                        logger.info("Upload successful with REST API method")
-                    else:
-                        raise Exception(f"REST API upload failed: {rest_response.status_code} - {rest_response.text}")
-                        
-                except Exception as e2:
-                    logger.error(f"REST API method also failed: {e2}")
-                    raise Exception(f"All upload methods failed: {e2}")
+                    self._upload_resumable(bucket_name, storage_path, file_path)
+                    upload_successful = True
+                    logger.info("Upload successful with resumable upload")
+                except Exception as e0:
+                    logger.warning(f"Resumable upload failed, falling back to single-request upload: {e0}")
             
             if not upload_successful:
-                raise Exception("Upload failed with all methods")
+                # The method that last worked goes first, so a deployment
+                # where one of them is broken stops paying for it per upload
+                last_error = None
+                with open(file_path, "rb") as file_obj:
+                    for upload in list(self._upload_methods):
+                        try:
+                            file_obj.seek(0)
+                            upload(bucket_name, storage_path, file_obj)
+                        except Exception as e:
+                            last_error = e
+                            logger.warning(f"Upload via {upload.__name__} failed: {e}")
+                            continue
+                        upload_successful = True
+                        logger.info(f"Upload successful via {upload.__name__}")
+                        if upload is not self._upload_methods[0]:
+                            self._upload_methods = [upload] + [m for m in self._upload_methods if m is not upload]
+                        break
+                if not upload_successful:
+                    raise Exception(f"All upload methods failed: {last_error}")
             
             logger.info("Supabase upload successful, creating signed URL...")
             
@@ -559,59 +796,71 @@ class SupabaseClient:
             logger.error(f"Supabase Storage upload failed: {e}")
             raise Exception(f"Storage upload failed: {e}")
     
-    async def refresh_video_url(self, video_id: str) -> Optional[str]:
+    def refresh_video_urls(self, video_ids: List[str]) -> Dict[str, str]:
         """
-        Refresh the signed URL for a video stored in Supabase Storage
-        
+        Sign URLs for many Supabase Storage videos at once
+
+        Cached URLs are returned as-is. The rest take one SELECT, one
+        create_signed_urls call per bucket and one update_video_urls RPC to
+        write them back, however many videos are involved.
+
         Args:
-            video_id: ID of the video
-            
+            video_ids: IDs of the videos
+
         Returns:
-            Fresh signed URL or None if failed
+            Dict of video_id -> signed URL for every video that could be signed
         """
+        urls: Dict[str, str] = {}
+        with self._video_urls_lock:
+            for video_id in video_ids:
+                url = self._video_urls.get(video_id)
+                if url:
+                    urls[video_id] = url
+        missing = [video_id for video_id in video_ids if video_id not in urls]
+        if not missing:
+            return urls
+
         try:
-            # Get the video record
-            video = self.get_video(video_id)
-            if not video:
-                logger.error(f"Video not found for refresh: {video_id}")
-                return None
-                
-            # Check if it uses Supabase Storage
-            if video.get("storage_provider") != "supabase":
-                logger.warning(f"Video {video_id} does not use Supabase Storage")
-                return None
-                
-            file_path = video.get("file_path")
-            if not file_path:
-                logger.error(f"Video {video_id} has no file path")
-                return None
-                
-            # Parse the storage path (format: "bucket/path")
-            storage_parts = file_path.split('/', 1)
-            if len(storage_parts) != 2:
-                logger.error(f"Invalid storage path format: {file_path}")
-                return None
-                
-            bucket = storage_parts[0]
-            path = storage_parts[1]
-            
-            # Generate a new signed URL
-            fresh_url = self.admin_client.storage.from_(bucket).create_signed_url(
-                path=path,
-                expires_in=3600 * 24  # 24 hours
-            )
-            
-            # Update the video record with the new URL
-            self.admin_client.table("videos").update({
-                "file_url": fresh_url
-            }).eq("id", video_id).execute()
-            
-            logger.info(f"Refreshed signed URL for video {video_id}")
-            return fresh_url
-            
+            result = (self.admin_client.table("videos")
+                     .select("id, file_path")
+                     .in_("id", missing)
+                     .eq("storage_provider", "supabase")
+                     .execute())
+
+            # Group storage paths (format: "bucket/path") by bucket
+            by_bucket: Dict[str, Dict[str, str]] = {}
+            for video in result.data or []:
+                storage_parts = (video.get("file_path") or "").split('/', 1)
+                if len(storage_parts) != 2:
+                    logger.error(f"Invalid storage path format: {video.get('file_path')}")
+                    continue
+                bucket, path = storage_parts
+                by_bucket.setdefault(bucket, {})[path] = video["id"]
+
+            fresh: Dict[str, str] = {}
+            for bucket, videos_by_path in by_bucket.items():
+                signed = self.admin_client.storage.from_(bucket).create_signed_urls(
+                    list(videos_by_path),
+                    VIDEO_URL_EXPIRES_IN
+                )
+                for item in signed:
+                    url = item.get("signedURL") or item.get("signedUrl")
+                    video_id = videos_by_path.get(item.get("path"))
+                    if url and video_id and not item.get("error"):
+                        fresh[video_id] = url
+
+            if fresh:
+                self.admin_client.rpc("update_video_urls", {
+                    "urls": [{"id": video_id, "file_url": url} for video_id, url in fresh.items()]
+                }).execute()
+                with self._video_urls_lock:
+                    self._video_urls.update(fresh)
+                logger.info(f"Refreshed signed URLs for {len(fresh)} videos")
+
+            urls.update(fresh)
         except Exception as e:
-            logger.error(f"Error refreshing video URL: {e}")
-            return None
+            logger.error(f"Error refreshing video URLs: {e}")
+        return urls
 
 
 # Global instance
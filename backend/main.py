@@ -5,7 +5,7 @@ Main FastAPI application for AutoVision backend
 import os
 import sys
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 # Add project root to Python path
 project_root = Path(__file__).parent.parent
@@ -19,35 +19,59 @@ from contextlib import asynccontextmanager
 import uvicorn
 from loguru import logger
 import asyncio
+import anyio
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Worker threads available to sync (def) route handlers. Supabase calls are
+# blocking, so the AnyIO default of 40 caps concurrent DB-bound requests.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200"))
+
+# Hour of day (UTC) at which the daily video cleanup runs. Keyed on the wall
+# clock so worker restarts don't keep pushing the next run back by a day.
+CLEANUP_HOUR_UTC = int(os.getenv("CLEANUP_HOUR_UTC", "3"))
+
 # Import AutoVision modules
 from backend.video_processor import VideoProcessor
-from backend.video_cleanup import run_scheduled_cleanup
+from backend.video_cleanup import run_scheduled_cleanup, video_cleanup_service
 from backend.api_routes import create_api_router
 
 
+def _seconds_until_next_cleanup() -> float:
+    """Seconds from now until the next CLEANUP_HOUR_UTC:00"""
+    now = datetime.now(timezone.utc)
+    next_run = now.replace(hour=CLEANUP_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return (next_run - now).total_seconds()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager"""
     # Startup
     logger.info("Starting AutoVision backend...")
+
+    # Widen the threadpool used for sync route handlers
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
     
     # Initialize video processor
     video_processor = VideoProcessor()
     app.state.video_processor = video_processor
+
+    # Pay model first-run costs before serving traffic
+    await asyncio.to_thread(video_processor.warmup)
     
     # Start video processing queue
     video_processor.start_processing()
     
-    # Start background cleanup task (runs every 24 hours)
+    # Start background cleanup task (runs daily at CLEANUP_HOUR_UTC)
     async def scheduled_cleanup_task():
         while True:
             try:
-                await asyncio.sleep(24 * 60 * 60)  # Wait 24 hours
+                await asyncio.sleep(_seconds_until_next_cleanup())
                 logger.info("Running scheduled video cleanup...")
                 await run_scheduled_cleanup()
             except Exception as e:
@@ -71,6 +95,10 @@ async def lifespan(app: FastAPI):
             await app.state.cleanup_task
         except asyncio.CancelledError:
             pass
+    await asyncio.to_thread(video_cleanup_service.shutdown)
+
+    # Flush queued RL training data
+    await app.state.video_processor.shutdown()
     
     logger.info("AutoVision backend shutdown complete")
 
@@ -160,6 +188,14 @@ async def health_check(request: Request):
         )
 
 
+# Prometheus metrics (e.g. supabase_op_seconds), when prometheus_client is installed
+try:
+    from prometheus_client import make_asgi_app
+    app.mount("/metrics", make_asgi_app())
+except ImportError:
+    logger.debug("prometheus_client not installed; /metrics disabled")
+
+
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """Custom HTTP exception handler"""
@@ -174,8 +210,8 @@ async def http_exception_handler(request, exc):
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
-    """General exception handler"""
-    logger.error(f"Unhandled exception: {exc}")
+    """General exception handler for errors raised outside API routes"""
+    logger.opt(exception=exc).error(f"Unhandled exception in {request.method} {request.url.path}: {exc}")
     return JSONResponse(
         status_code=500,
         content={
@@ -3,22 +3,56 @@ Video cleanup module for AutoVision
 Handles automatic deletion of old videos based on user settings
 """
 
+import asyncio
 import os
 import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from loguru import logger
+from postgrest.types import ReturnMethod
 from pathlib import Path
 
 from backend.autovision_client import supabase_client
 
+# Cap on cleanup runs executing at once; a manual run that cannot get a
+# slot within CLEANUP_SLOT_TIMEOUT_SECONDS is turned away instead of queued
+MAX_CONCURRENT_CLEANUPS = int(os.getenv("MAX_CONCURRENT_CLEANUPS", "2"))
+CLEANUP_SLOT_TIMEOUT_SECONDS = float(os.getenv("CLEANUP_SLOT_TIMEOUT_SECONDS", "5"))
+
+# Video ids per events/videos delete request; keeps the in.(...) filter well
+# under URL length limits for users with a large backlog of old videos
+CLEANUP_DELETE_BATCH_SIZE = int(os.getenv("CLEANUP_DELETE_BATCH_SIZE", "200"))
+
+
+class CleanupBusyError(RuntimeError):
+    """Raised when every cleanup slot is taken and a manual run has to be retried later"""
+
 
 class VideoCleanupService:
     """Service for cleaning up old videos based on user settings"""
     
     def __init__(self):
         self.client = supabase_client.get_admin_client()
+        self._cleanup_slots = asyncio.Semaphore(MAX_CONCURRENT_CLEANUPS)
+        # Cleanup runs blocking Supabase/storage/file I/O; it gets its own
+        # worker threads so a long sweep neither stalls the event loop nor
+        # starves the default threadpool serving sync request handlers
+        # (one spare thread keeps previews from waiting behind sweeps)
+        self._executor = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_CLEANUPS + 1, thread_name_prefix="video-cleanup"
+        )
         logger.info("Video cleanup service initialized")
+
+    def shutdown(self):
+        """Stop the cleanup worker threads, letting in-flight work finish"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    async def _in_worker(self, func, *args):
+        """Run a blocking call on the cleanup worker threads"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
     
     async def cleanup_old_videos(self, user_id: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -30,6 +64,10 @@ class VideoCleanupService:
         Returns:
             Dict with cleanup statistics
         """
+        async with self._cleanup_slots:
+            return await self._cleanup_old_videos(user_id)
+
+    async def _cleanup_old_videos(self, user_id: Optional[str]) -> Dict[str, Any]:
         try:
             cleanup_stats = {
                 "users_processed": 0,
@@ -45,7 +83,7 @@ class VideoCleanupService:
             else:
                 users_query = self.client.table("user_settings").select("user_id, video_retention_days").eq("auto_delete_old_videos", True)
             
-            users_result = users_query.execute()
+            users_result = await self._in_worker(users_query.execute)
             
             if not users_result.data:
                 logger.info("No users with auto-delete enabled found")
@@ -56,7 +94,7 @@ class VideoCleanupService:
                 retention_days = user_settings["video_retention_days"]
                 
                 try:
-                    user_stats = await self._cleanup_user_videos(user_id, retention_days)
+                    user_stats = await self._in_worker(self._cleanup_user_videos, user_id, retention_days)
                     cleanup_stats["users_processed"] += 1
                     cleanup_stats["videos_deleted"] += user_stats["videos_deleted"]
                     cleanup_stats["files_deleted"] += user_stats["files_deleted"]
@@ -74,8 +112,8 @@ class VideoCleanupService:
             logger.error(f"Error in video cleanup: {e}")
             raise
     
-    async def _cleanup_user_videos(self, user_id: str, retention_days: int) -> Dict[str, Any]:
-        """Clean up videos for a specific user"""
+    def _cleanup_user_videos(self, user_id: str, retention_days: int) -> Dict[str, Any]:
+        """Clean up videos for a specific user (blocking; runs on the cleanup workers)"""
         
         cutoff_date = datetime.utcnow() - timedelta(days=retention_days)
         cutoff_str = cutoff_date.isoformat()
@@ -83,68 +121,87 @@ class VideoCleanupService:
         logger.info(f"Cleaning up videos for user {user_id} older than {cutoff_str}")
         
         # Get old videos for this user
-        videos_result = self.client.table("videos").select("*").eq("user_id", user_id).lt("created_at", cutoff_str).execute()
+        videos_result = self.client.table("videos").select("id, file_path, file_size, storage_provider").eq("user_id", user_id).lt("created_at", cutoff_str).execute()
         
         if not videos_result.data:
             logger.info(f"No old videos found for user {user_id}")
             return {"videos_deleted": 0, "files_deleted": 0, "space_freed_mb": 0}
         
         stats = {"videos_deleted": 0, "files_deleted": 0, "space_freed_mb": 0}
+        videos = videos_result.data
+        # Only videos whose file is gone (or never existed) lose their
+        # records; a failed storage delete keeps the row so the next sweep
+        # retries it instead of orphaning the object
+        removed_ids = []
         
-        for video in videos_result.data:
+        # Group Supabase Storage objects by bucket so each bucket is cleared
+        # with one remove() call; legacy local files are removed directly
+        storage_paths = defaultdict(list)
+        for video in videos:
+            file_path = video.get("file_path")
+            file_size = video.get("file_size") or 0
+            storage_provider = video.get("storage_provider")
+            
+            if storage_provider == "supabase" and file_path:
+                # Parse the storage path (format: "bucket/path")
+                storage_parts = file_path.split('/', 1)
+                if len(storage_parts) == 2:
+                    storage_paths[storage_parts[0]].append((video["id"], storage_parts[1], file_size))
+                else:
+                    removed_ids.append(video["id"])
+            # Fallback for local files (backward compatibility)
+            elif file_path and os.path.exists(file_path):
+                try:
+                    os.remove(file_path)
+                    removed_ids.append(video["id"])
+                    stats["files_deleted"] += 1
+                    stats["space_freed_mb"] += file_size / (1024 * 1024)  # Convert to MB
+                    logger.info(f"Deleted local file: {file_path}")
+                except Exception as e:
+                    logger.warning(f"Failed to delete local file {file_path}: {e}")
+            else:
+                removed_ids.append(video["id"])
+        
+        for bucket, entries in storage_paths.items():
             try:
-                video_id = video["id"]
-                file_path = video.get("file_path")
-                file_size = video.get("file_size", 0)
-                
-                # Delete associated events first
-                self.client.table("events").delete().eq("video_id", video_id).execute()
-                logger.info(f"Deleted events for video {video_id}")
-                  # Delete video file based on storage provider
-                storage_provider = video.get("storage_provider")
-                
-                if storage_provider == "supabase" and file_path:
-                    try:
-                        # Parse the storage path (format: "bucket/path")
-                        storage_parts = file_path.split('/', 1)
-                        if len(storage_parts) == 2:
-                            bucket = storage_parts[0]
-                            path = storage_parts[1]
-                            
-                            # Delete from Supabase Storage
-                            self.client.storage.from_(bucket).remove(path)
-                            stats["files_deleted"] += 1
-                            stats["space_freed_mb"] += file_size / (1024 * 1024)  # Convert to MB
-                            logger.info(f"Deleted file from Supabase Storage: {file_path}")
-                    except Exception as e:
-                        logger.warning(f"Failed to delete file from Supabase Storage {file_path}: {e}")
-                # Fallback for local files (backward compatibility)
-                elif file_path and os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                        stats["files_deleted"] += 1
-                        stats["space_freed_mb"] += file_size / (1024 * 1024)  # Convert to MB
-                        logger.info(f"Deleted local file: {file_path}")
-                    except Exception as e:
-                        logger.warning(f"Failed to delete local file {file_path}: {e}")
-                
-                # Delete video record from database
-                self.client.table("videos").delete().eq("id", video_id).execute()
-                stats["videos_deleted"] += 1
-                logger.info(f"Deleted video record: {video_id}")
-                
+                self.client.storage.from_(bucket).remove([path for _, path, _ in entries])
+                removed_ids.extend(video_id for video_id, _, _ in entries)
+                stats["files_deleted"] += len(entries)
+                stats["space_freed_mb"] += sum(size for _, _, size in entries) / (1024 * 1024)  # Convert to MB
+                logger.info(f"Deleted {len(entries)} files from Supabase Storage bucket {bucket}")
             except Exception as e:
-                logger.error(f"Failed to delete video {video.get('id', 'unknown')}: {e}")
-                continue
+                logger.warning(f"Failed to delete files from Supabase Storage bucket {bucket}: {e}")
+        
+        # Delete associated events, then the video records, a bounded batch
+        # of ids per request
+        for start in range(0, len(removed_ids), CLEANUP_DELETE_BATCH_SIZE):
+            batch = removed_ids[start:start + CLEANUP_DELETE_BATCH_SIZE]
+            self.client.table("events").delete(returning=ReturnMethod.minimal).in_("video_id", batch).execute()
+            self.client.table("videos").delete(returning=ReturnMethod.minimal).in_("id", batch).execute()
+            supabase_client.forget_videos(batch)
+            stats["videos_deleted"] += len(batch)
+        if removed_ids:
+            logger.info(f"Deleted {len(removed_ids)} video records and their events")
+        skipped = len(videos) - len(removed_ids)
+        if skipped:
+            logger.warning(f"Kept {skipped} video records for user {user_id} whose files could not be deleted")
         
         logger.info(f"User {user_id} cleanup completed: {stats}")
         return stats
     
     async def cleanup_user_videos_manual(self, user_id: str) -> Dict[str, Any]:
         """Manually trigger cleanup for a specific user"""
+        try:
+            await asyncio.wait_for(self._cleanup_slots.acquire(), timeout=CLEANUP_SLOT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Rejected manual cleanup for user {user_id}: all {MAX_CONCURRENT_CLEANUPS} cleanup slots busy")
+            raise CleanupBusyError("Cleanup backlog full, retry later")
+
         try:
             # Get user settings
-            settings_result = self.client.table("user_settings").select("video_retention_days, auto_delete_old_videos").eq("user_id", user_id).execute()
+            settings_result = await self._in_worker(
+                self.client.table("user_settings").select("video_retention_days, auto_delete_old_videos").eq("user_id", user_id).execute
+            )
             
             if not settings_result.data:
                 raise ValueError("User settings not found")
@@ -156,17 +213,21 @@ class VideoCleanupService:
             
             retention_days = settings.get("video_retention_days", 30)
             
-            return await self._cleanup_user_videos(user_id, retention_days)
+            return await self._in_worker(self._cleanup_user_videos, user_id, retention_days)
             
         except Exception as e:
             logger.error(f"Error in manual cleanup for user {user_id}: {e}")
             raise
+        finally:
+            self._cleanup_slots.release()
     
     async def get_cleanup_preview(self, user_id: str) -> Dict[str, Any]:
         """Get a preview of what would be cleaned up without actually deleting"""
         try:
             # Get user settings
-            settings_result = self.client.table("user_settings").select("video_retention_days, auto_delete_old_videos").eq("user_id", user_id).execute()
+            settings_result = await self._in_worker(
+                self.client.table("user_settings").select("video_retention_days, auto_delete_old_videos").eq("user_id", user_id).execute
+            )
             
             if not settings_result.data:
                 return {"error": "User settings not found"}
@@ -181,7 +242,9 @@ class VideoCleanupService:
             cutoff_str = cutoff_date.isoformat()
             
             # Get old videos for this user
-            videos_result = self.client.table("videos").select("id, original_name, file_size, created_at").eq("user_id", user_id).lt("created_at", cutoff_str).execute()
+            videos_result = await self._in_worker(
+                self.client.table("videos").select("id, original_name, file_size, created_at").eq("user_id", user_id).lt("created_at", cutoff_str).execute
+            )
             
             if not videos_result.data:
                 return {"videos_to_delete": 0, "space_to_free_mb": 0, "message": "No old videos to delete"}
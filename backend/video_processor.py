@@ -6,7 +6,7 @@ Handles video upload, frame extraction, and anomaly detection
 import os
 import cv2
 import numpy as np
-from typing import List, Dict, Optional, Tuple, Any
+from typing import List, Dict, Optional, Tuple, Any, BinaryIO
 import asyncio
 from pathlib import Path
 import tempfile
@@ -14,12 +14,13 @@ import shutil
 from datetime import datetime
 import uuid
 from loguru import logger
+from postgrest.types import ReturnMethod
 import json
 
 from ai_models.simple_anomaly_detector import create_anomaly_detector
-from ai_models.simple_rl_controller import create_rl_controller
+from ai_models.simple_rl_controller import create_rl_controller, ACTION_UP
 from ai_models.simple_rag_system import create_rag_system
-from backend.autovision_client import supabase_client
+from backend.autovision_client import supabase_client, bbox_columns
 
 # Score above which an anomaly event is flagged as a high-priority alert.
 ALERT_SCORE_THRESHOLD = float(os.getenv("ALERT_SCORE_THRESHOLD", "0.8"))
@@ -37,6 +38,22 @@ CROWD_CONTOUR_THRESHOLD = int(os.getenv("CROWD_CONTOUR_THRESHOLD", "3"))
 RUNNING_VELOCITY_PX_PER_SEC = float(os.getenv("RUNNING_VELOCITY_PX_PER_SEC", "150"))
 LOITERING_DURATION_SECONDS = float(os.getenv("LOITERING_DURATION_SECONDS", "8"))
 
+# Non-critical rows (system logs, RL training data) are written by a
+# background task: the queue bounds memory if Supabase is slow (overflow is
+# dropped, not awaited), and each insert carries up to DB_WRITE_BATCH_SIZE rows.
+DB_WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "1024"))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "64"))
+
+# A processed video's anomaly events are inserted this many rows per request
+EVENT_INSERT_BATCH_SIZE = int(os.getenv("EVENT_INSERT_BATCH_SIZE", "500"))
+
+
+def _copy_to_path(file_obj: BinaryIO, path: str) -> int:
+    """Copy file_obj to path in 1MB chunks and return the bytes written"""
+    with open(path, "wb") as f:
+        shutil.copyfileobj(file_obj, f, 1024 * 1024)
+        return f.tell()
+
 
 class AnomalyTypes:
     NORMAL = "normal"
@@ -177,7 +194,8 @@ class FrameProcessor:
                 # Persist the pattern (with its real embedding) so RAG retrieval
                 # survives restarts and can be shared across videos for this user.
                 try:
-                    await supabase_client.save_historical_pattern(
+                    await asyncio.to_thread(
+                        supabase_client.save_historical_pattern,
                         user_id=user_id,
                         pattern_type=anomaly_type,
                         embedding=frame_features.tolist(),
@@ -195,7 +213,8 @@ class FrameProcessor:
                 # cosine similarity of the actual frame embedding) into the
                 # analysis context, rather than only the in-process cache.
                 try:
-                    similar_patterns = supabase_client.search_similar_patterns(
+                    similar_patterns = await asyncio.to_thread(
+                        supabase_client.search_similar_patterns,
                         user_id=user_id,
                         embedding=frame_features.tolist(),
                         pattern_type=anomaly_type,
@@ -328,6 +347,13 @@ class VideoProcessor:
           # Processing queue
         self.processing_queue = asyncio.Queue()
         self.is_processing = False
+
+        # Logs and RL training rows are persisted by a background writer so
+        # request handlers and video processing never wait on a Supabase
+        # round-trip; items are (table, row) pairs
+        self._db_write_queue = asyncio.Queue(maxsize=DB_WRITE_QUEUE_SIZE)
+        self._db_write_task = None
+        self.db_writes_dropped = 0
         
         # Statistics
         self.stats = {
@@ -352,19 +378,110 @@ class VideoProcessor:
                 .select("next_state_vector").order("created_at", desc=True).limit(1).execute()
             if result.data and result.data[0].get("next_state_vector"):
                 restored = float(result.data[0]["next_state_vector"][0])
-                self.rl_controller.current_threshold = restored
+                self.rl_controller.set_threshold(restored)
                 logger.info(f"Restored RL threshold from persisted training data: {restored:.3f}")
         except Exception as e:
             logger.warning(f"Could not restore RL threshold from history, using default: {e}")
 
+    def warmup(self):
+        """
+        Run the detector once on a blank frame so one-time costs (ONNX
+        Runtime arena allocation, OpenCV kernel setup) are paid at startup
+        rather than by the first processed video. The RL feedback kernel is
+        already compiled by create_rl_controller().
+        """
+        frame = np.zeros((64, 64, 3), dtype=np.uint8)
+        warmup_id = "__warmup__"
+        try:
+            self.anomaly_detector.detect_anomaly(frame, video_id=warmup_id, frame_number=0, fps=30.0)
+            self.anomaly_detector.extract_features(frame)
+            logger.info("Video processor models warmed up")
+        except Exception as e:
+            logger.warning(f"Model warm-up failed, first video will pay init costs: {e}")
+        finally:
+            # Drop the per-video detector state the dummy frame created
+            finalize_video = getattr(self.anomaly_detector, "finalize_video", None)
+            if finalize_video:
+                finalize_video(warmup_id)
+
     def start_processing(self):
         """Start the background video processing task"""
         if not self.is_processing:
             asyncio.create_task(self._process_queue())
             logger.info("Video processing queue started")
+        self._start_db_writer()
+
+    def _start_db_writer(self):
+        """Start the background database writer if it isn't already running"""
+        if self._db_write_task is None or self._db_write_task.done():
+            self._db_write_task = asyncio.create_task(self._db_writer())
+
+    def _queue_db_write(self, table: str, row: Dict[str, Any]) -> bool:
+        """Queue a row for the background writer; drops it if the queue is full"""
+        self._start_db_writer()
+        try:
+            self._db_write_queue.put_nowait((table, row))
+            return True
+        except asyncio.QueueFull:
+            self.db_writes_dropped += 1
+            logger.warning(f"Database write queue full, dropped {table} row ({self.db_writes_dropped} total)")
+            return False
+
+    def _log_event(self, message: str, log_level: str = "INFO", user_id: Optional[str] = None,
+                   video_id: Optional[str] = None, event_id: Optional[str] = None):
+        """Record a system log entry in the logs table without waiting on it"""
+        self._queue_db_write("logs", {
+            "message": message,
+            "log_level": log_level,
+            "user_id": user_id,
+            "video_id": video_id,
+            "event_id": event_id,
+            "metadata": None
+        })
+
+    async def _db_writer(self):
+        """Drain queued rows and insert them in batches, one request per table"""
+        while True:
+            items = [await self._db_write_queue.get()]
+            while len(items) < DB_WRITE_BATCH_SIZE and not self._db_write_queue.empty():
+                items.append(self._db_write_queue.get_nowait())
+            batches: Dict[str, List[Dict[str, Any]]] = {}
+            for table, row in items:
+                batches.setdefault(table, []).append(row)
+            try:
+                for table, rows in batches.items():
+                    await asyncio.to_thread(supabase_client.insert_batch, table, rows)
+            except Exception as e:
+                logger.warning(f"Failed to persist background write batch: {e}")
+            finally:
+                for _ in items:
+                    self._db_write_queue.task_done()
+
+    async def shutdown(self):
+        """Flush pending background writes and stop the writer"""
+        if self._db_write_task is None:
+            return
+        try:
+            await asyncio.wait_for(self._db_write_queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self._db_write_queue.qsize()} unsaved rows on shutdown")
+        self._db_write_task.cancel()
+        try:
+            await self._db_write_task
+        except asyncio.CancelledError:
+            pass
     
-    async def upload_video(self, file_data: bytes, filename: str, user_id: str) -> Dict[str, Any]:
-        """Upload and process a video file"""
+    async def upload_video(self, file_obj: BinaryIO, filename: str, user_id: str) -> Dict[str, Any]:
+        """
+        Upload and process a video file
+
+        Args:
+            file_obj: readable binary file positioned at the start of the video
+                (e.g. the spooled upload body); copied to disk in chunks
+                off the event loop
+            filename: original filename
+            user_id: uploading user
+        """
         
         try:
             # Generate unique IDs
@@ -376,15 +493,15 @@ class VideoProcessor:
             temp_dir = tempfile.mkdtemp()
             temp_filepath = os.path.join(temp_dir, unique_filename)
             
-            with open(temp_filepath, "wb") as f:
-                f.write(file_data)
+            file_size = await asyncio.to_thread(_copy_to_path, file_obj, temp_filepath)
             
             # Extract metadata
-            metadata = VideoMetadata(temp_filepath)
+            metadata = await asyncio.to_thread(VideoMetadata, temp_filepath)
             
             # Upload to Supabase Storage
-            storage_result = await supabase_client.upload_video_to_storage(
-                file_data=file_data,
+            storage_result = await asyncio.to_thread(
+                supabase_client.upload_video_to_storage,
+                file_path=temp_filepath,
                 user_id=user_id,
                 filename=filename
             )
@@ -400,7 +517,7 @@ class VideoProcessor:
                     "original_name": filename,
                     "file_path": storage_result['storage_path'],
                     "file_url": storage_result['public_url'],
-                    "file_size": len(file_data),
+                    "file_size": file_size,
                     "duration_seconds": metadata.duration,
                     "fps": metadata.fps,
                     "resolution": f"{metadata.width}x{metadata.height}" if metadata.width and metadata.height else None,
@@ -408,7 +525,9 @@ class VideoProcessor:
                     "storage_provider": storage_result['storage_provider'],  # Use provider from storage result
                     "storage_id": storage_result.get('storage_id')
                 }
-                supabase_client.get_admin_client().table("videos").insert(supabase_video_data).execute()
+                await asyncio.to_thread(
+                    supabase_client.get_admin_client().table("videos").insert(supabase_video_data, returning=ReturnMethod.minimal).execute
+                )
                 logger.info(f"Video record saved to Supabase: {video_id}")
 
             except Exception as e:
@@ -420,7 +539,7 @@ class VideoProcessor:
                     if len(storage_parts) == 2:
                         bucket = storage_parts[0]
                         path = storage_parts[1]
-                        supabase_client.get_admin_client().storage.from_(bucket).remove(path)
+                        await asyncio.to_thread(supabase_client.get_admin_client().storage.from_(bucket).remove, path)
                         logger.info(f"Cleaned up orphaned storage file: {storage_result['storage_path']}")
                 except Exception as cleanup_error:
                     logger.error(f"Failed to clean up storage after error: {cleanup_error}")
@@ -428,7 +547,7 @@ class VideoProcessor:
                 raise Exception(f"Failed to save video record: {e}")
             
             logger.info(f"Video uploaded event for user {user_id}, video {video_id}, filename {filename}")
-            await supabase_client.create_log(
+            self._log_event(
                 message=f"Video uploaded: {filename}",
                 log_level="INFO",
                 user_id=user_id,
@@ -499,18 +618,24 @@ class VideoProcessor:
         cleanup_dir = job["cleanup_dir"]
         
         start_time = datetime.utcnow()
+
+        # Each video run is one RL episode: fold any feedback buffered since
+        # the last run (RL_BATCH_SIZE > 1) into the threshold it will use
+        self.rl_controller.end_episode()
         
         try:
             # Update video status in Supabase
             try:
-                supabase_client.get_admin_client().table("videos").update({"upload_status": "processing"}).eq("id", video_id).execute()
+                await asyncio.to_thread(
+                    supabase_client.get_admin_client().table("videos").update({"upload_status": "processing"}, returning=ReturnMethod.minimal).eq("id", video_id).execute
+                )
                 logger.info(f"Updated video status in Supabase: {video_id} -> processing")
             except Exception as e:
                 logger.error(f"Failed to update video status in Supabase: {e}")
                 # Continue processing despite database update failure
 
             logger.info(f"Video processing started for video {video_id}")
-            await supabase_client.create_log(
+            self._log_event(
                 message=f"Video processing started: {video_id}",
                 log_level="INFO", user_id=user_id, video_id=video_id
             )
@@ -519,8 +644,10 @@ class VideoProcessor:
             # the process-wide default (FRAME_SAMPLING_RATE env) if unset.
             frame_sampling_rate = self.frame_processor.frame_sampling_rate
             try:
-                settings_result = supabase_client.get_admin_client().table("user_settings") \
-                    .select("frame_sampling_rate").eq("user_id", user_id).execute()
+                settings_result = await asyncio.to_thread(
+                    supabase_client.get_admin_client().table("user_settings")
+                    .select("frame_sampling_rate").eq("user_id", user_id).execute
+                )
                 if settings_result.data and settings_result.data[0].get("frame_sampling_rate"):
                     frame_sampling_rate = settings_result.data[0]["frame_sampling_rate"]
             except Exception as e:
@@ -543,10 +670,11 @@ class VideoProcessor:
             
             # Update video status in Supabase using admin client
             try:
-                supabase_client.get_admin_client().table("videos").update({
-                    "upload_status": "completed",
-                    "updated_at": datetime.utcnow().isoformat()
-                }).eq("id", video_id).execute()
+                await asyncio.to_thread(
+                    supabase_client.get_admin_client().table("videos").update({
+                        "upload_status": "completed"
+                    }, returning=ReturnMethod.minimal).eq("id", video_id).execute
+                )
                 logger.info(f"Updated video status in Supabase: {video_id} -> completed")
             except Exception as supabase_error:
                 logger.error(f"Failed to update video status in Supabase: {supabase_error}")
@@ -562,7 +690,7 @@ class VideoProcessor:
             self.stats["processing_time_total"] += processing_time
 
             logger.info(f"Video processing completed: {video_id} in {processing_time:.2f}s")
-            await supabase_client.create_log(
+            self._log_event(
                 message=f"Video processing completed: {len(results)} frames, {anomalies_detected} anomalies",
                 log_level="INFO", user_id=user_id, video_id=video_id
             )
@@ -572,16 +700,17 @@ class VideoProcessor:
 
             # Update video status to failed
             try:
-                supabase_client.get_admin_client().table("videos").update({
-                    "upload_status": "failed",
-                    "updated_at": datetime.utcnow().isoformat()
-                }).eq("id", video_id).execute()
+                await asyncio.to_thread(
+                    supabase_client.get_admin_client().table("videos").update({
+                        "upload_status": "failed"
+                    }, returning=ReturnMethod.minimal).eq("id", video_id).execute
+                )
                 logger.info(f"Updated video status in Supabase: {video_id} -> failed")
             except Exception as supabase_error:
                 logger.error(f"Failed to update video status in Supabase: {supabase_error}")
 
             logger.error(f"Video processing failed for video {video_id}: {str(e)}")
-            await supabase_client.create_log(
+            self._log_event(
                 message=f"Video processing failed: {str(e)}",
                 log_level="ERROR", user_id=user_id, video_id=video_id
             )
@@ -647,10 +776,11 @@ class VideoProcessor:
                                      results: List[Dict[str, Any]]):
         """Save processing results to database"""
         
+        events = []
         for result in results:
             if result.get("is_anomaly", False):
                 # Create event data
-                event_data = {
+                events.append({
                     "video_id": video_id,
                     "user_id": user_id,
                     "event_type": result["anomaly_type"],
@@ -658,28 +788,28 @@ class VideoProcessor:
                     "confidence": result["confidence"],
                     "timestamp_seconds": result["timestamp_seconds"],
                     "frame_number": result["frame_number"],
-                    "bounding_box": result.get("bounding_box"),
+                    **bbox_columns(result.get("bounding_box")),
                     "description": f"Anomaly detected: {result['anomaly_type']} with score {result['anomaly_score']:.2f}",
                     "explanation": result.get("rag_analysis", {}).get("explanation"),
                     "recommendations": result.get("rag_analysis", {}).get("recommendations"),
                     "is_alert": float(result["anomaly_score"]) > ALERT_SCORE_THRESHOLD
-                }
-                
-                # Save to Supabase
-                try:
-                    # Insert event into Supabase events table using admin client to bypass RLS
-                    supabase_client.get_admin_client().table("events").insert(event_data).execute()
-                    logger.info(f"Event saved to Supabase: {event_data}")
-                except Exception as e:
-                    logger.error(f"Failed to save event to Supabase: {e}")
-                    # Continue processing even if individual event save fails
-                    logger.warning(f"Continuing processing despite event save failure")
+                })
+        
+        # Save to Supabase in batches, one round trip per EVENT_INSERT_BATCH_SIZE
+        # rows; a failed batch is logged and the remaining batches still go out
+        saved = 0
+        for start in range(0, len(events), EVENT_INSERT_BATCH_SIZE):
+            batch = events[start:start + EVENT_INSERT_BATCH_SIZE]
+            if await asyncio.to_thread(supabase_client.create_events_batch, batch):
+                saved += len(batch)
+        if events:
+            logger.info(f"Saved {saved}/{len(events)} events to Supabase for video {video_id}")
     
     async def get_video_analysis(self, video_id: str, user_id: str) -> Dict[str, Any]:
         """Get analysis results for a video"""        
         try:
             # Get video record from Supabase
-            video = supabase_client.get_video(video_id)
+            video = await asyncio.to_thread(supabase_client.get_video, video_id)
             if not video:
                 raise Exception("Video not found")
             
@@ -690,12 +820,14 @@ class VideoProcessor:
             events = []
             try:
                 # Query events table for this video
-                response = supabase_client.get_admin_client() \
-                    .table("events") \
-                    .select("*") \
-                    .eq("video_id", video_id) \
-                    .order("timestamp_seconds", desc=False) \
-                    .execute()
+                response = await asyncio.to_thread(
+                    supabase_client.get_admin_client()
+                    .table("events")
+                    .select("*")
+                    .eq("video_id", video_id)
+                    .order("timestamp_seconds", desc=False)
+                    .execute
+                )
                 
                 if response.data:
                     events = response.data
@@ -757,8 +889,10 @@ class VideoProcessor:
 
         try:
             # Verify the event exists and belongs to this user before mutating it
-            event = supabase_client.get_admin_client().table("events") \
-                .select("id, user_id").eq("id", event_id).execute()
+            event = await asyncio.to_thread(
+                supabase_client.get_admin_client().table("events")
+                .select("id, user_id").eq("id", event_id).execute
+            )
             if not event.data:
                 logger.warning(f"Feedback rejected: event {event_id} not found")
                 return False
@@ -767,7 +901,7 @@ class VideoProcessor:
                 return False
 
             # Persist the feedback on the event itself
-            updated = supabase_client.update_event_feedback(event_id, is_false_positive)
+            updated = await asyncio.to_thread(supabase_client.update_event_feedback, event_id, is_false_positive)
             if not updated:
                 return False
 
@@ -782,18 +916,19 @@ class VideoProcessor:
             threshold_after = self.rl_controller.adjust_threshold(feedback)
 
             # Persist the RL step so training state survives restarts and can
-            # be inspected/replayed later.
-            try:
-                await supabase_client.save_rl_training_data(
-                    user_id=user_id,
-                    state_vector=[threshold_before],
-                    action=1 if is_false_positive else 0,
-                    reward=feedback_score,
-                    next_state_vector=[threshold_after],
-                    done=False
-                )
-            except Exception as e:
-                logger.warning(f"Failed to persist RL training data: {e}")
+            # be inspected/replayed later. Queued for the background writer;
+            # if it is saturated the row is dropped rather than blocking.
+            # rl_training_data.action keeps its original encoding (1 = the
+            # threshold was raised, 0 = it was not), derived from the move
+            # actually applied rather than the controller's ACTION_* index.
+            self._queue_db_write("rl_training_data", {
+                "user_id": user_id,
+                "state_vector": [threshold_before],
+                "action": 1 if self.rl_controller.last_action == ACTION_UP else 0,
+                "reward": feedback_score,
+                "next_state_vector": [threshold_after],
+                "done": False
+            })
 
             # Update RAG system (if method exists)
             if hasattr(self.rag_system, 'update_pattern_from_feedback'):
@@ -802,7 +937,7 @@ class VideoProcessor:
                 )
 
             logger.info(f"Feedback processed for event {event_id}: {feedback_score}")
-            await supabase_client.create_log(
+            self._log_event(
                 message=f"Feedback recorded for event {event_id}: false_positive={is_false_positive}, score={feedback_score}",
                 log_level="INFO", user_id=user_id, event_id=event_id
             )
@@ -822,5 +957,9 @@ class VideoProcessor:
             "statistics": self.stats,
             "rl_controller": self.rl_controller.get_training_summary(),
             "rag_system": self.rag_system.get_statistics(),
-            "current_threshold": self.rl_controller.get_current_threshold()
+            "current_threshold": self.rl_controller.get_current_threshold(),
+            "background_writes": {
+                "queued": self._db_write_queue.qsize(),
+                "dropped": self.db_writes_dropped
+            }
         }
\ No newline at end of file
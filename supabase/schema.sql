@@ -12,6 +12,8 @@
 
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 CREATE EXTENSION IF NOT EXISTS "pgcrypto";
+-- pgvector: RAG pattern embeddings are searched by cosine distance in-database
+CREATE EXTENSION IF NOT EXISTS vector WITH SCHEMA extensions;
 
 -- ============================================================================
 -- 1. USER PROFILES
@@ -81,7 +83,11 @@ CREATE TABLE IF NOT EXISTS public.events (
     confidence REAL NOT NULL DEFAULT 0.0,
     timestamp_seconds REAL NOT NULL,
     frame_number INTEGER NOT NULL,
-    bounding_box JSONB,
+    -- Bounding box of the detection in frame pixels (NULL when there is none)
+    bbox_x SMALLINT,
+    bbox_y SMALLINT,
+    bbox_w SMALLINT,
+    bbox_h SMALLINT,
     description TEXT,
     explanation TEXT,
     recommendations JSONB,
@@ -91,11 +97,34 @@ CREATE TABLE IF NOT EXISTS public.events (
 );
 
 ALTER TABLE public.events
-    ADD COLUMN IF NOT EXISTS bounding_box JSONB,
+    ADD COLUMN IF NOT EXISTS bbox_x SMALLINT,
+    ADD COLUMN IF NOT EXISTS bbox_y SMALLINT,
+    ADD COLUMN IF NOT EXISTS bbox_w SMALLINT,
+    ADD COLUMN IF NOT EXISTS bbox_h SMALLINT,
     ADD COLUMN IF NOT EXISTS is_false_positive BOOLEAN DEFAULT FALSE,
     ADD COLUMN IF NOT EXISTS explanation TEXT,
     ADD COLUMN IF NOT EXISTS recommendations JSONB;
 
+-- Databases created earlier stored the box as a bounding_box JSONB object
+-- ({x, y, width, height}); move it into the bbox_* columns and drop it
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public'
+        AND table_name = 'events'
+        AND column_name = 'bounding_box'
+    ) THEN
+        UPDATE public.events
+        SET bbox_x = (bounding_box->>'x')::SMALLINT,
+            bbox_y = (bounding_box->>'y')::SMALLINT,
+            bbox_w = (bounding_box->>'width')::SMALLINT,
+            bbox_h = (bounding_box->>'height')::SMALLINT
+        WHERE bounding_box IS NOT NULL;
+        ALTER TABLE public.events DROP COLUMN bounding_box;
+    END IF;
+END $$;
+
 -- ============================================================================
 -- 4. USER SETTINGS
 -- ============================================================================
@@ -119,7 +148,7 @@ CREATE TABLE IF NOT EXISTS public.historical_patterns (
     id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
     user_id UUID REFERENCES auth.users(id) NOT NULL,
     pattern_type TEXT NOT NULL,
-    embedding REAL[] NOT NULL,
+    embedding extensions.vector(100) NOT NULL,
     description TEXT NOT NULL,
     metadata JSONB,
     frequency_count INTEGER DEFAULT 1,
@@ -127,6 +156,23 @@ CREATE TABLE IF NOT EXISTS public.historical_patterns (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Databases created before pgvector stored embeddings as REAL[]; convert
+-- them in place (every detector emits 100-d feature vectors)
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public'
+        AND table_name = 'historical_patterns'
+        AND column_name = 'embedding'
+        AND data_type = 'ARRAY'
+    ) THEN
+        ALTER TABLE public.historical_patterns
+            ALTER COLUMN embedding TYPE extensions.vector(100)
+            USING embedding::extensions.vector(100);
+    END IF;
+END $$;
+
 -- ============================================================================
 -- 6. RL TRAINING DATA
 -- ============================================================================
@@ -167,12 +213,19 @@ CREATE INDEX IF NOT EXISTS idx_videos_user_id ON public.videos(user_id);
 CREATE INDEX IF NOT EXISTS idx_videos_created_at ON public.videos(created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_videos_status ON public.videos(upload_status);
 CREATE INDEX IF NOT EXISTS idx_videos_storage_provider ON public.videos(storage_provider);
+-- Serves the retention cleanup/preview range filter (user_id = ? AND
+-- created_at < cutoff) and the per-user newest-first video list
+CREATE INDEX IF NOT EXISTS idx_videos_user_created ON public.videos(user_id, created_at DESC);
 
 CREATE INDEX IF NOT EXISTS idx_events_video_id ON public.events(video_id);
 CREATE INDEX IF NOT EXISTS idx_events_user_id ON public.events(user_id);
 CREATE INDEX IF NOT EXISTS idx_events_created_at ON public.events(created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_events_anomaly_score ON public.events(anomaly_score DESC);
 CREATE INDEX IF NOT EXISTS idx_events_event_type ON public.events(event_type);
+-- Filter + sort orders of the event list queries: a user's newest events,
+-- and one video's events in playback order
+CREATE INDEX IF NOT EXISTS idx_events_user_created ON public.events(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_events_video_timestamp ON public.events(video_id, timestamp_seconds);
 
 CREATE INDEX IF NOT EXISTS idx_user_settings_user_id ON public.user_settings(user_id);
 
@@ -181,6 +234,13 @@ CREATE INDEX IF NOT EXISTS idx_patterns_type ON public.historical_patterns(patte
 CREATE INDEX IF NOT EXISTS idx_patterns_frequency ON public.historical_patterns(frequency_count DESC);
 CREATE UNIQUE INDEX IF NOT EXISTS idx_patterns_dedup
     ON public.historical_patterns(user_id, pattern_type, description);
+-- No table-wide ANN index on embedding: retrieval is always per user, and a
+-- global approximate index (IVFFlat or HNSW) filtered by user_id afterwards
+-- loses recall for users with a small share of the table. Per-user recall is
+-- exact instead, see match_historical_patterns. Earlier versions created
+-- these indexes; drop them so the planner can't choose them.
+DROP INDEX IF EXISTS public.idx_patterns_embedding;
+DROP INDEX IF EXISTS public.idx_patterns_embedding_half;
 
 CREATE INDEX IF NOT EXISTS idx_rl_data_user_id ON public.rl_training_data(user_id);
 CREATE INDEX IF NOT EXISTS idx_rl_data_created_at ON public.rl_training_data(created_at DESC);
@@ -371,6 +431,47 @@ BEGIN
 END;
 $$;
 
+-- Token validation and profile lookup in one call. Invoked through PostgREST
+-- with the user's own access token as the bearer, so PostgREST has already
+-- verified the JWT signature and expiry and auth.uid() is the caller. The
+-- session check keeps tokens revoked by sign-out from resolving. Returns no
+-- rows for unknown/unverified users.
+DROP FUNCTION IF EXISTS public.get_profile_for_token();
+
+CREATE FUNCTION public.get_profile_for_token()
+RETURNS TABLE (
+    id UUID,
+    email TEXT,
+    full_name TEXT,
+    avatar_url TEXT,
+    is_system_user BOOLEAN
+)
+LANGUAGE plpgsql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    IF (auth.jwt() ->> 'session_id') IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM auth.sessions s
+        WHERE s.id = (auth.jwt() ->> 'session_id')::UUID
+    ) THEN
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+    SELECT
+        up.id,
+        COALESCE(up.email, au.email::TEXT),
+        up.full_name,
+        up.avatar_url,
+        up.is_system_user
+    FROM public.user_profiles up
+    JOIN auth.users au ON au.id = up.id
+    WHERE up.id = auth.uid();
+END;
+$$;
+
 DROP FUNCTION IF EXISTS public.update_video_storage(UUID, TEXT, TEXT, TEXT, TEXT);
 
 CREATE FUNCTION public.update_video_storage(
@@ -426,6 +527,128 @@ BEGIN
 END;
 $$;
 
+-- Single round-trip delete for the API: removes the video's events and the
+-- video row itself, scoped to its owner, and hands back the storage path so
+-- the caller can remove the object. Returns no rows when the video does not
+-- exist or belongs to another user.
+DROP FUNCTION IF EXISTS public.delete_video_cascade(UUID, UUID);
+
+CREATE FUNCTION public.delete_video_cascade(vid UUID, uid UUID)
+RETURNS TABLE (file_path TEXT)
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+    DELETE FROM public.events e
+    WHERE e.video_id = vid
+    AND e.user_id = uid;
+
+    RETURN QUERY
+    DELETE FROM public.videos v
+    WHERE v.id = vid
+    AND v.user_id = uid
+    RETURNING v.file_path;
+END;
+$$;
+
+-- Records one sighting of a RAG pattern in a single statement: inserts it on
+-- first sight, otherwise bumps frequency_count and last_seen on the existing
+-- row (deduplicated by idx_patterns_dedup). Atomic, so concurrent sightings
+-- are all counted.
+DROP FUNCTION IF EXISTS public.upsert_historical_pattern(UUID, TEXT, TEXT, REAL[], JSONB);
+DROP FUNCTION IF EXISTS public.upsert_historical_pattern(UUID, TEXT, TEXT, extensions.vector, JSONB);
+
+CREATE FUNCTION public.upsert_historical_pattern(
+    uid UUID,
+    ptype TEXT,
+    descr TEXT,
+    emb extensions.vector(100),
+    meta JSONB DEFAULT NULL
+)
+RETURNS VOID
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    INSERT INTO public.historical_patterns (user_id, pattern_type, description, embedding, metadata, frequency_count)
+    VALUES (uid, ptype, descr, emb, meta, 1)
+    ON CONFLICT (user_id, pattern_type, description) DO UPDATE SET
+        frequency_count = public.historical_patterns.frequency_count + 1,
+        last_seen = NOW();
+$$;
+
+-- RAG retrieval: a user's patterns nearest to a query embedding by cosine
+-- distance, optionally restricted to one pattern type. The user's rows are
+-- fetched first (via idx_patterns_dedup, which leads with user_id and
+-- pattern_type) and ranked exactly; the MATERIALIZED CTE keeps the planner
+-- from ranking through a table-wide ANN index and filtering by user only
+-- afterwards, which would drop rows for users holding a small share of the
+-- table. Per-user pattern counts are small (rows are deduplicated by type
+-- and description), so the exact scan is cheap and always returns the
+-- user's best min(match_count, their pattern count) patterns.
+DROP FUNCTION IF EXISTS public.match_historical_patterns(UUID, extensions.vector, TEXT, INTEGER);
+
+CREATE FUNCTION public.match_historical_patterns(
+    uid UUID,
+    query_embedding extensions.vector(100),
+    ptype TEXT DEFAULT NULL,
+    match_count INTEGER DEFAULT 5
+)
+RETURNS TABLE (
+    id UUID,
+    pattern_type TEXT,
+    description TEXT,
+    metadata JSONB,
+    frequency_count INTEGER,
+    last_seen TIMESTAMP WITH TIME ZONE,
+    similarity DOUBLE PRECISION
+)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public, extensions
+AS $$
+    WITH user_patterns AS MATERIALIZED (
+        SELECT
+            hp.id,
+            hp.pattern_type,
+            hp.description,
+            hp.metadata,
+            hp.frequency_count,
+            hp.last_seen,
+            hp.embedding <=> query_embedding AS distance
+        FROM public.historical_patterns hp
+        WHERE hp.user_id = uid
+        AND (ptype IS NULL OR hp.pattern_type = ptype)
+    )
+    SELECT
+        up.id,
+        up.pattern_type,
+        up.description,
+        up.metadata,
+        up.frequency_count,
+        up.last_seen,
+        1 - up.distance AS similarity
+    FROM user_patterns up
+    ORDER BY up.distance
+    LIMIT match_count;
+$$;
+
+-- Writes back a batch of refreshed signed URLs in one statement. Takes a JSON
+-- array of {"id": ..., "file_url": ...} objects; only existing rows are
+-- touched, so a video deleted meanwhile is not recreated.
+DROP FUNCTION IF EXISTS public.update_video_urls(JSONB);
+
+CREATE FUNCTION public.update_video_urls(urls JSONB)
+RETURNS VOID
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    UPDATE public.videos v
+    SET file_url = u.file_url
+    FROM jsonb_to_recordset(urls) AS u(id UUID, file_url TEXT)
+    WHERE v.id = u.id;
+$$;
+
 -- ============================================================================
 -- 11. STORAGE BUCKET
 -- ============================================================================
@@ -458,8 +681,13 @@ GRANT ALL ON public.logs TO anon, authenticated, service_role;
 
 GRANT EXECUTE ON FUNCTION public.get_user_settings(UUID) TO anon, authenticated, service_role;
 GRANT EXECUTE ON FUNCTION public.get_verified_user_profile(UUID) TO anon, authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.get_profile_for_token() TO authenticated;
 GRANT EXECUTE ON FUNCTION public.update_video_storage(UUID, TEXT, TEXT, TEXT, TEXT) TO anon, authenticated, service_role;
 GRANT EXECUTE ON FUNCTION public.cleanup_old_videos(UUID, INTEGER) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.delete_video_cascade(UUID, UUID) TO service_role;
+GRANT EXECUTE ON FUNCTION public.upsert_historical_pattern(UUID, TEXT, TEXT, extensions.vector, JSONB) TO service_role;
+GRANT EXECUTE ON FUNCTION public.match_historical_patterns(UUID, extensions.vector, TEXT, INTEGER) TO service_role;
+GRANT EXECUTE ON FUNCTION public.update_video_urls(JSONB) TO service_role;
 
 GRANT ALL ON storage.buckets TO service_role;
 GRANT ALL ON storage.objects TO service_role;
@@ -511,14 +739,14 @@ BEGIN
     SELECT COUNT(*) INTO function_count
     FROM information_schema.routines
     WHERE routine_schema = 'public'
-    AND routine_name IN ('get_user_settings', 'get_verified_user_profile', 'update_video_storage', 'cleanup_old_videos');
+    AND routine_name IN ('get_user_settings', 'get_verified_user_profile', 'update_video_storage', 'cleanup_old_videos', 'delete_video_cascade', 'get_profile_for_token', 'upsert_historical_pattern', 'match_historical_patterns', 'update_video_urls');
 
     RAISE NOTICE 'Setup verification: % tables, % functions', table_count, function_count;
 
-    IF table_count = 7 AND function_count = 4 THEN
+    IF table_count = 7 AND function_count = 9 THEN
         RAISE NOTICE 'AutoVision database schema applied successfully!';
     ELSE
-        RAISE WARNING 'Expected 7 tables and 4 functions, found % tables and % functions.', table_count, function_count;
+        RAISE WARNING 'Expected 7 tables and 9 functions, found % tables and % functions.', table_count, function_count;
     END IF;
 END $$;
 